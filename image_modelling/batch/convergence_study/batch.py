@@ -0,0 +1,48 @@
+# Find the cheapest gridsize and beam_ratio meeting an accuracy target
+# Add local scripts to module search path
+import sys
+import os
+sys.path.append(os.path.realpath('../../toliman-proper'))
+
+from convergence import convergence_study, recommend, save_recommendation
+
+prescription = 'prescription_rc_quad'
+
+toliman_settings = {
+                    'diam': 0.001 * 2. * 150, 
+                    'm1_fl': 571.7300 / 1000.,
+                    'm1_m2_sep': 549.240/1000.,
+                    'm2_fl': -23.3800/1000.,
+                    'bfl': 590.000 / 1000., 
+                    'm2_rad': 5.9 / 1000., 
+                    'm2_strut_width': 0.01,
+                    'm2_supports': 5,
+                    'tilt_x': 0.00,
+                    'tilt_y': 0.00
+                    }
+
+detector_pitch = 11.0e-6 # m/pixel on detector
+npixels = 512 # Size of detector, in pixels
+
+# Single source, on axis, monochromatic
+source_a = {
+            'wavelengths': [0.6],
+            'weights': [1.],
+            'settings': toliman_settings
+            }
+
+gridsizes = [1024, 1536, 2048, 3072, 4096]
+beam_ratios = [0.2, 0.3, 0.4]
+# Largest acceptable differences from the reference image
+tolerance = {'rms': 1e-4, 'centroid': 1e-3, 'peak': 1e-3}
+
+results = convergence_study(prescription, [source_a], detector_pitch, npixels, gridsizes, beam_ratios)
+for r in results:
+    print('{gridsize:5d} {beam_ratio:.2f} {runtime:8.2f}s rms {rms:.2e} centroid {centroid:.2e} peak {peak:.2e}'.format(**r))
+
+best = recommend(results, tolerance)
+if best is None:
+    print('No configuration meets the tolerance')
+else:
+    print('Recommended gridsize {} beam_ratio {}'.format(best['gridsize'], best['beam_ratio']))
+    save_recommendation(prescription, best)
@@ -0,0 +1,69 @@
+# Calibrate the resource model used to pack jobs onto nodes
+# Add local scripts to module search path
+import sys
+import os
+sys.path.append(os.path.realpath('../../toliman-proper'))
+
+import functools
+from resource_model import measure, calibrate, save_model
+from spirals import binarized_ringed
+from warmup import warm_cache
+
+prescription = 'prescription_rc_quad'
+
+# Bind the spiral phase, as opd_func is called as opd_func(r, phi); the name
+# identifies it in cache names
+opd_func = functools.partial(binarized_ringed, phase=650.*1e-9*0.5)
+opd_func.__name__ = 'binarized_ringed_phase3.25e-07'
+
+toliman_settings = {
+                    'diam': 0.001 * 2. * 150, 
+                    'm1_fl': 571.7300 / 1000.,
+                    'm1_m2_sep': 549.240/1000.,
+                    'm2_fl': -23.3800/1000.,
+                    'bfl': 590.000 / 1000., 
+                    'm2_rad': 5.9 / 1000., 
+                    'm2_strut_width': 0.01,
+                    'm2_supports': 5,
+                    'beam_ratio': 0.4,
+                    'tilt_x': 0.00,
+                    'tilt_y': 0.00,
+                    'opd_func': opd_func
+                    }
+
+detector_pitch = 11.0e-6 # m/pixel on detector
+npixels = 512 # Size of detector, in pixels
+
+wl_gauss = [5.999989e-01,
+            6.068356e-01,
+            6.173624e-01,
+            6.270944e-01 ]
+
+gridsizes = [512, 1024, 2048]
+wavelength_counts = [1, 4]
+
+if __name__ == '__main__':
+    measurements = []
+    for gridsize in gridsizes:
+        # Build the grids first, so the cached runs measure only cache hits
+        warm_cache(prescription, [{'wavelengths': wl_gauss, 'weights': [1.]*len(wl_gauss),
+                                   'settings': toliman_settings}], {}, gridsize)
+        for nwl in wavelength_counts:
+            for multi in (False, True):
+                for use_caching in (False, True):
+                    source = {'wavelengths': wl_gauss[:nwl],
+                              'weights': [1./nwl]*nwl,
+                              'settings': dict(toliman_settings, use_caching=use_caching)}
+                    m = measure(prescription, [source], gridsize, detector_pitch, npixels, multi=multi)
+                    measurements.append(m)
+                    print('{:5d} {} wavelengths multi {:d} caching {:d}: {:8.1f} MB {:8.2f}s'.format(
+                          gridsize, nwl, multi, use_caching, m['memory']/1e6, m['runtime']))
+    model = calibrate(measurements)
+    save_model(model)
+    print('Saved model {}'.format(model))
+    # Check the fit
+    for m in measurements:
+        memory = sum(c*f for c, f in zip(model['memory'], m['features']['memory']))
+        runtime = sum(c*f for c, f in zip(model['runtime'], m['features']['runtime']))
+        print('memory {:8.1f} MB predicted {:8.1f} MB, runtime {:8.2f}s predicted {:8.2f}s'.format(
+              m['memory']/1e6, memory/1e6, m['runtime'], runtime))
@@ -2,11 +2,11 @@
 # Add local scripts to module search path
 import sys
 import os
-import numpy as np
-import pickle
 sys.path.append(os.path.realpath('../../toliman-proper'))
 
-from proper_tools import form_detector_image
+import functools
+from sweep import run_sweep
+from warmup import warm_cache
 import spirals
 
 gridsize = 2048 # sampling of wavefront
@@ -17,6 +17,10 @@ npixels = 512 # Size of detector, in pixels
 vpmin = 256-64
 vpmax = 256+64
 
+# Bind the spiral phase, as opd_func is called as opd_func(r, phi); the name
+# identifies it in cache names
+opd_func = functools.partial(spirals.binarized_ringed, phase=650.*1e-9*0.5)
+opd_func.__name__ = 'binarized_ringed_phase3.25e-07'
 
 toliman_settings = {
                     # Barnaby's values:
@@ -33,7 +37,8 @@ toliman_settings = {
                     'beam_ratio': 0.4,
                     'tilt_x': 0.00,
                     'tilt_y': 0.00,    
-                    'phase_func': spirals.binarized_ringed
+                    'opd_func': opd_func,
+                    'use_caching': True
                     }
 
 
@@ -73,11 +78,17 @@ source_b = {
 
 delta_x = 1e-6
 prescription ='prescription_rc_quad'
-for i in range(100):
-    tilted['tilt_x'] = 3.00 + i*delta_x
-    tilted['tilt_y'] = 0.00
-    fname = '{:09f}-{:09f}_{}'.format(tilted['tilt_x'], tilted['tilt_y'], prescription)
-    if not os.path.exists(fname):
-        detector_image = form_detector_image(prescription, [source_a, source_b], gridsize, detector_pitch, npixels)
-        with open(fname, 'wb') as outfile:
-            pickle.dump(detector_image, outfile)
+# Tilt of the second source; completed points are skipped on restart
+grid = {'1/tilt_x': [3.00 + i*delta_x for i in range(100)],
+        '1/tilt_y': [0.00]}
+if __name__ == '__main__':
+    # Build static grids up front so the sweep itself runs on cache hits
+    warm_cache(prescription, [source_a, source_b], grid, gridsize)
+    if len(sys.argv) > 1 and sys.argv[1] == 'shard':
+        # Run on each node against a shared filesystem, then merge from any
+        # one node with: python work_queue.py merge results
+        from work_queue import init_queue, run_worker
+        init_queue('results', prescription, [source_a, source_b], grid, gridsize, detector_pitch, npixels)
+        run_worker('results')
+    else:
+        run_sweep('results', prescription, [source_a, source_b], grid, gridsize, detector_pitch, npixels)
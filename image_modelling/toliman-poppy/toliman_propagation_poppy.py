@@ -21,6 +21,9 @@ import astropy.units as u
 # import pysynphot as S
 import logging
 
+# See toliman-proper/telescope.py for the telescope as run by prescription_rc_quad,
+# built for POPPY from the same parameters and benchmarked against PROPER.
+
 # Positions for un-folded telescope, relative to input pupil
 pupil_m2_dist = 0.5 * u.m
 m1_m2_dist = 549.337630333726 * u.mm
@@ -0,0 +1,172 @@
+import numpy as np
+import os
+
+# Suffixes of the files making up a packed grid. The levels file is written
+# last, so its presence marks a complete entry.
+PACKED_BITS = '.bits.npy'
+PACKED_SPARSE = '.sparse.npy'
+PACKED_LEVELS = '.levels.npy'
+
+# Pack only when at most this fraction of pixels lie between the two levels
+MAX_SPARSE_FRACTION = 0.05
+
+SPARSE_DTYPE = np.dtype([('index', np.int64), ('value', np.float64)])
+
+def pack_grid(grid, max_sparse_fraction=MAX_SPARSE_FRACTION):
+    """Encode a mostly two-level grid as a bitmask, two levels and sparse edges
+
+    Masks (0 and 1) and binary OPD maps (0 and a fixed OPD) take only two
+    values, apart from anti-aliased edge pixels. These are stored as a
+    bit-packed mask of which level each pixel takes plus a sparse list of the
+    pixels taking neither.
+
+    Parameters
+    ----------
+    grid : numpy ndarray
+        Real 2D grid to encode
+
+    max_sparse_fraction : float
+        Largest fraction of pixels that may be stored sparsely
+
+    Returns
+    -------
+    packed : tuple or None
+        (bits, sparse, levels) arrays, or None if the grid is not suitable
+        for packing.
+    """
+    if np.iscomplexobj(grid) or grid.ndim != 2:
+        return None
+    values, counts = np.unique(grid, return_counts=True)
+    order = np.argsort(counts)[::-1]
+    levels = values[order[:2]]
+    if levels.size == 1:
+        levels = np.array([levels[0], levels[0]])
+    is_high = grid == levels[1]
+    other = ~is_high & (grid != levels[0])
+    nsparse = np.count_nonzero(other)
+    if nsparse > max_sparse_fraction * grid.size:
+        return None
+    sparse = np.empty(nsparse, dtype = SPARSE_DTYPE)
+    sparse['index'] = np.flatnonzero(other)
+    sparse['value'] = grid[other]
+    bits = np.packbits(is_high.ravel())
+    header = np.array([levels[0], levels[1], grid.shape[0], grid.shape[1]], dtype = np.float64)
+    return bits, sparse, header
+
+def unpack_grid(bits, sparse, header):
+    """Decode a grid encoded by pack_grid
+
+    Parameters
+    ----------
+    bits, sparse, header : numpy ndarray
+        Arrays as returned by pack_grid
+
+    Returns
+    -------
+    grid : numpy ndarray
+        Decoded 2D grid of float64
+    """
+    shape = (int(header[2]), int(header[3]))
+    n = shape[0] * shape[1]
+    is_high = np.unpackbits(bits)[:n].astype(bool).reshape(shape)
+    grid = np.where(is_high, header[1], header[0])
+    grid.flat[sparse['index']] = sparse['value']
+    return grid
+
+def _atomic_save(name, arr):
+    # Write to a temporary file alongside, then rename over the target, so
+    # readers never see a partly-written file.
+    tmp = '{}.{}.tmp'.format(name, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, name)
+
+def _stem(name):
+    return name[:-4] if name.endswith('.npy') else name
+
+def save_grid(name, grid):
+    """Save a grid, packing it if it is essentially two-level
+
+    Each file is written atomically, and the file marking a packed grid as
+    complete is written last.
+
+    Parameters
+    ----------
+    name : str
+        Filename of the grid, ending in .npy
+
+    grid : numpy ndarray
+        Grid to save
+    """
+    packed = pack_grid(grid)
+    if packed is None:
+        _atomic_save(name, grid)
+    else:
+        stem = _stem(name)
+        bits, sparse, header = packed
+        _atomic_save(stem + PACKED_BITS, bits)
+        _atomic_save(stem + PACKED_SPARSE, sparse)
+        _atomic_save(stem + PACKED_LEVELS, header)
+
+def grid_files(name):
+    """List the files that may make up a stored grid
+
+    Parameters
+    ----------
+    name : str
+        Filename of the grid, ending in .npy
+
+    Returns
+    -------
+    files : list of str
+        Plain and packed filenames for the grid, whether or not they exist
+    """
+    stem = _stem(name)
+    return [stem + '.npy', stem + PACKED_BITS, stem + PACKED_SPARSE, stem + PACKED_LEVELS]
+
+def grid_name(filename):
+    """Name of the grid that a stored file belongs to
+
+    Parameters
+    ----------
+    filename : str
+        A file written by save_grid
+
+    Returns
+    -------
+    name : str
+        The name the grid was saved under, ending in .npy
+    """
+    for suffix in (PACKED_BITS, PACKED_SPARSE, PACKED_LEVELS):
+        if filename.endswith(suffix):
+            return filename[:-len(suffix)] + '.npy'
+    return filename
+
+def load_grid(name):
+    """Load a grid saved by save_grid
+
+    The stored arrays are memory mapped, so only the (much smaller) packed
+    data of a packed grid is read from disk, and a plain grid is only read
+    as it is used.
+
+    Parameters
+    ----------
+    name : str
+        Filename of the grid, ending in .npy
+
+    Returns
+    -------
+    grid : numpy ndarray
+        The grid
+
+    Raises
+    ------
+    IOError
+        If no grid of that name is stored
+    """
+    stem = _stem(name)
+    if os.path.exists(stem + PACKED_LEVELS):
+        return unpack_grid(np.load(stem + PACKED_BITS, mmap_mode='r'),
+                           np.load(stem + PACKED_SPARSE, mmap_mode='r'),
+                           np.load(stem + PACKED_LEVELS))
+    return np.load(name, mmap_mode='r')
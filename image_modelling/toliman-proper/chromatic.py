@@ -0,0 +1,232 @@
+import numpy as np
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+
+def propagate_anchors(prescription, settings, wavelengths, gridsize, multi=True):
+    """Propagate complex focal plane fields at anchor wavelengths
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run; must support 'noabs'
+
+    settings : dict
+        PASSVALUE settings for the prescription
+
+    wavelengths : list of float
+        Anchor wavelengths in microns. These should span the wavelengths to
+        be interpolated.
+
+    gridsize : int
+        Size of the wavefront grid
+
+    multi : bool
+        Use prop_run_multi to propagate all anchors in parallel
+
+    Returns
+    -------
+    anchors : dict
+        'wavelengths' (sorted), complex 'fields' and their 'samplings'
+    """
+    wavelengths = sorted(wavelengths)
+    settings = dict(settings, noabs=True)
+    if multi is True:
+        (fields, samplings) = proper.prop_run_multi(prescription, wavelengths, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+    else:
+        fields = []
+        samplings = []
+        for wl in wavelengths:
+            (field, sampling) = proper.prop_run(prescription, wl, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+            fields.append(field)
+            samplings.append(sampling)
+    return {'wavelengths': np.array(wavelengths),
+            'fields': np.asarray(fields),
+            'samplings': np.asarray(samplings)}
+
+def scaled_field(field, sampling, anchor_wl, wavelength, common_sampling, npsf):
+    """Resample an anchor field to the coordinates of another wavelength
+
+    Diffraction patterns scale with wavelength, so the field at anchor_wl,
+    magnified by wavelength/anchor_wl, approximates the field at wavelength.
+    The result is sampled at common_sampling and scaled to conserve flux.
+
+    Parameters
+    ----------
+    field : numpy ndarray
+        Complex focal plane field at anchor_wl
+
+    sampling : float
+        Sampling of field in metres
+
+    anchor_wl, wavelength : float
+        Anchor and target wavelengths
+
+    common_sampling : float
+        Output sampling in metres
+
+    npsf : int
+        Output dimension
+
+    Returns
+    -------
+    out : numpy ndarray
+        Complex field of dimension npsf
+    """
+    mag = sampling * wavelength / (common_sampling * anchor_wl)
+    out = proper.prop_magnify(np.real(field), mag, npsf) + 1j * proper.prop_magnify(np.imag(field), mag, npsf)
+    return out / mag
+
+def _lagrange_weights(x, nodes):
+    w = np.ones(len(nodes))
+    for i in range(len(nodes)):
+        for j in range(len(nodes)):
+            if i != j:
+                w[i] *= (x - nodes[j]) / (nodes[i] - nodes[j])
+    return w
+
+def _nearest(anchor_wls, wavelength, count):
+    # Indices of the count anchors nearest to wavelength, in wavelength order
+    order = np.argsort(np.abs(anchor_wls - wavelength), kind='stable')
+    return np.sort(order[:count])
+
+def interpolate_psf(anchors, wavelength, common_sampling, npsf, order=1, exclude=None):
+    """PSF at a wavelength interpolated from anchor fields
+
+    The nearest order+1 anchor fields are resampled to the wavelength-scaled
+    coordinates of the target wavelength, aligned in global phase, and
+    combined with Lagrange weights in wavelength.
+
+    Parameters
+    ----------
+    anchors : dict
+        Anchor fields, from propagate_anchors
+
+    wavelength : float
+        Target wavelength in microns
+
+    common_sampling : float
+        Output sampling in metres, e.g. detector_pitch/2
+
+    npsf : int
+        Output dimension, e.g. 2*npixels
+
+    order : int
+        Order of the interpolating polynomial (1 for linear)
+
+    exclude : int
+        Index of an anchor not to use, for error estimation
+
+    Returns
+    -------
+    psf : numpy ndarray
+        Intensity PSF, as produced by normalise_sampling for an exact run
+    """
+    anchor_wls = anchors['wavelengths']
+    usable = [i for i in range(len(anchor_wls)) if i != exclude]
+    idx = [usable[i] for i in _nearest(anchor_wls[usable], wavelength, order + 1)]
+    weights = _lagrange_weights(wavelength, anchor_wls[idx])
+    field = 0.
+    ref = None
+    for i, weight in zip(idx, weights):
+        f = scaled_field(anchors['fields'][i], anchors['samplings'][i], anchor_wls[i], wavelength, common_sampling, npsf)
+        if ref is None:
+            ref = f
+        else:
+            # Remove any global phase difference between anchors
+            overlap = np.vdot(ref, f)
+            if overlap != 0:
+                f *= np.conj(overlap) / np.abs(overlap)
+        field = field + weight * f
+    return np.abs(field)**2
+
+def chromatic_psfs(anchors, wavelengths, common_sampling, npsf, order=1):
+    """Stack of interpolated PSFs at many wavelengths
+
+    Parameters
+    ----------
+    anchors : dict
+        Anchor fields, from propagate_anchors
+
+    wavelengths : list of float
+        Wavelengths in microns
+
+    common_sampling, npsf, order :
+        As for interpolate_psf
+
+    Returns
+    -------
+    psfs : numpy ndarray
+        PSFs, one per wavelength
+    """
+    out = np.zeros([len(wavelengths), npsf, npsf], dtype = np.float64)
+    for i, wl in enumerate(wavelengths):
+        out[i,:,:] = interpolate_psf(anchors, wl, common_sampling, npsf, order)
+    return out
+
+def _relative_rms(psf, exact):
+    return np.sqrt(np.sum((psf - exact)**2) / np.sum(exact**2))
+
+def interpolation_error(anchors, common_sampling, npsf, order=1):
+    """Estimate the interpolation error from the anchors alone
+
+    Each interior anchor is interpolated from the others and compared with
+    its exact PSF. Anchor spacing is doubled around the omitted anchor, so
+    this overestimates the error of interpolating with all anchors, and
+    serves as a bound without further propagation.
+
+    Parameters
+    ----------
+    anchors : dict
+        Anchor fields, from propagate_anchors
+
+    common_sampling, npsf, order :
+        As for interpolate_psf
+
+    Returns
+    -------
+    error : float
+        Largest relative RMS difference over the interior anchors
+
+    Raises
+    ------
+    ValueError
+        If there are fewer than three anchors, so none is interior
+    """
+    if len(anchors['wavelengths']) < 3:
+        raise ValueError('Estimating the interpolation error needs at least 3 anchors, got {}'.format(len(anchors['wavelengths'])))
+    errors = []
+    for k in range(1, len(anchors['wavelengths']) - 1):
+        wl = anchors['wavelengths'][k]
+        exact = np.abs(scaled_field(anchors['fields'][k], anchors['samplings'][k], wl, wl, common_sampling, npsf))**2
+        psf = interpolate_psf(anchors, wl, common_sampling, npsf, order, exclude=k)
+        errors.append(_relative_rms(psf, exact))
+    return max(errors)
+
+def validate_interpolation(prescription, settings, anchors, wavelengths, gridsize, common_sampling, npsf, order=1):
+    """Compare interpolated PSFs with exact propagations
+
+    Parameters
+    ----------
+    prescription, settings, gridsize :
+        As for propagate_anchors
+
+    anchors : dict
+        Anchor fields, from propagate_anchors
+
+    wavelengths : list of float
+        Test wavelengths in microns, ideally midway between anchors
+
+    common_sampling, npsf, order :
+        As for interpolate_psf
+
+    Returns
+    -------
+    errors : numpy ndarray
+        Relative RMS difference at each test wavelength
+    """
+    exact = propagate_anchors(prescription, settings, wavelengths, gridsize)
+    errors = []
+    for k, wl in enumerate(exact['wavelengths']):
+        psf = np.abs(scaled_field(exact['fields'][k], exact['samplings'][k], wl, wl, common_sampling, npsf))**2
+        errors.append(_relative_rms(interpolate_psf(anchors, wl, common_sampling, npsf, order), psf))
+    return np.array(errors)
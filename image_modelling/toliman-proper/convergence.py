@@ -0,0 +1,151 @@
+import numpy as np
+import json
+import os
+import time
+import proper_tools
+from proper_tools import form_detector_image
+from jitter import centroid
+
+def viewport(image, size=128):
+    """Central size by size region of a detector image"""
+    lo = image.shape[0]//2 - size//2
+    return image[lo:lo+size, lo:lo+size]
+
+def image_metrics(image, reference, size=128):
+    """Compare a detector image with a reference within the central viewport
+
+    Parameters
+    ----------
+    image, reference : numpy ndarray
+        Detector images of the same dimensions
+
+    size : int
+        Viewport size in pixels
+
+    Returns
+    -------
+    metrics : dict
+        'rms': RMS difference relative to the reference peak,
+        'centroid': centroid shift in pixels,
+        'peak': relative difference in peak flux
+    """
+    vp = viewport(image, size)
+    ref = viewport(reference, size)
+    ref_peak = np.max(ref)
+    return {'rms': np.sqrt(np.mean((vp - ref)**2)) / ref_peak,
+            'centroid': float(np.hypot(*(centroid(vp) - centroid(ref)))),
+            'peak': abs(np.max(vp) - ref_peak) / ref_peak}
+
+def grid_cost(gridsize):
+    """Relative cost of propagation at a gridsize, dominated by FFTs"""
+    return gridsize**2 * np.log2(gridsize)
+
+def with_beam_ratio(sources, beam_ratio):
+    """Copies of sources with beam_ratio set in their settings"""
+    return [dict(source, settings=dict(source['settings'], beam_ratio=beam_ratio)) for source in sources]
+
+def convergence_study(prescription, sources, detector_pitch, npixels, gridsizes, beam_ratios,
+                      reference=None, size=128, multi=True):
+    """Measure detector image convergence over a ladder of gridsizes and beam ratios
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+
+    sources : list of dict
+        Sources as passed to form_detector_image
+
+    detector_pitch, npixels :
+        As for form_detector_image
+
+    gridsizes : list of int
+        Gridsizes to try
+
+    beam_ratios : list of float
+        Beam ratios to try
+
+    reference : tuple
+        (gridsize, beam_ratio) of the reference image. Default is the
+        largest gridsize with the middle beam ratio of the ladder.
+
+    size : int
+        Viewport size in pixels for the metrics
+
+    multi : bool
+        As for form_detector_image
+
+    Returns
+    -------
+    results : list of dict
+        For each configuration, its 'gridsize', 'beam_ratio', modelled 'cost',
+        measured 'runtime' in seconds, and the metrics of image_metrics
+    """
+    if reference is None:
+        reference = (max(gridsizes), sorted(beam_ratios)[len(beam_ratios)//2])
+    images = {}
+    runtimes = {}
+    configs = [(n, b) for n in gridsizes for b in beam_ratios]
+    if tuple(reference) not in configs:
+        configs.append(tuple(reference))
+    for (n, b) in configs:
+        start = time.time()
+        images[(n, b)] = form_detector_image(prescription, with_beam_ratio(sources, b), n, detector_pitch, npixels, multi=multi)
+        runtimes[(n, b)] = time.time() - start
+    ref = images[tuple(reference)]
+    results = []
+    for (n, b) in configs:
+        result = {'gridsize': n, 'beam_ratio': b, 'cost': grid_cost(n), 'runtime': runtimes[(n, b)],
+                  'reference': (n, b) == tuple(reference)}
+        result.update(image_metrics(images[(n, b)], ref, size))
+        results.append(result)
+    return results
+
+def recommend(results, tolerance):
+    """Cheapest configuration meeting a tolerance
+
+    Parameters
+    ----------
+    results : list of dict
+        Results of convergence_study
+
+    tolerance : float or dict
+        Largest acceptable 'rms', or a dict of largest acceptable values for
+        any of 'rms', 'centroid' and 'peak'
+
+    Returns
+    -------
+    result : dict
+        The cheapest acceptable result, or None if no non-reference
+        configuration meets the tolerance
+    """
+    if not isinstance(tolerance, dict):
+        tolerance = {'rms': tolerance}
+    ok = [r for r in results if not r['reference'] and all(r[k] <= v for k, v in tolerance.items())]
+    if len(ok) == 0:
+        return None
+    return min(ok, key=lambda r: (r['cost'], r['runtime']))
+
+def save_recommendation(prescription, result, filename=None):
+    """Record a recommended configuration for use with gridsize='auto'
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription
+
+    result : dict
+        Result from recommend
+
+    filename : str
+        Configuration file; default is proper_tools.grid_config_file
+    """
+    if filename is None:
+        filename = proper_tools.grid_config_file
+    config = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            config = json.load(f)
+    config[prescription] = {'gridsize': int(result['gridsize']), 'beam_ratio': float(result['beam_ratio'])}
+    with open(filename, 'w') as f:
+        json.dump(config, f, indent=1)
@@ -0,0 +1,94 @@
+import numpy as np
+import os
+from collections import OrderedDict
+
+# Coordinate grids for the most recently used (ngrid, sampling) pairs, up to
+# a total size in bytes. Wavefronts at different planes and wavelengths
+# have different samplings, so the limit is on memory, not on pairs.
+max_bytes = int(os.environ.get('TOLIMAN_COORDINATES_MAX_BYTES', 256*2**20))
+_grids = OrderedDict()
+_sizes = {}
+
+def _build(ngrid, sampling, name):
+    if name == 'x1d':
+        # PROPER convention: centre at pixel ngrid//2
+        return (np.arange(ngrid, dtype = np.float64) - ngrid//2) * sampling
+    if name == 'x1d_shifted':
+        # As prop_shift_center, along one axis
+        return np.roll(coordinates(ngrid, sampling, 'x1d'), ngrid//2)
+    x1d = coordinates(ngrid, sampling, 'x1d')
+    if name == 'x':
+        return np.broadcast_to(x1d[:,np.newaxis], (ngrid, ngrid))
+    if name == 'y':
+        return np.broadcast_to(x1d[np.newaxis,:], (ngrid, ngrid))
+    if name == 'r2':
+        return x1d[:,np.newaxis]**2 + x1d[np.newaxis,:]**2
+    if name == 'r':
+        return np.sqrt(coordinates(ngrid, sampling, 'r2'))
+    if name == 'phi':
+        return np.arctan2(x1d[np.newaxis,:], x1d[:,np.newaxis])
+    raise ValueError('Unknown coordinate grid "{}"'.format(name))
+
+def coordinates(ngrid, sampling, name):
+    """Shared, read-only coordinate grid for a wavefront
+
+    All toliman-proper helpers take coordinates from here, so each grid is
+    only built once per (ngrid, sampling), and all agree on centring: the
+    centre is at pixel ngrid//2, as for PROPER, with x along the first axis
+    and y along the second. Grids are built on first use and cached, least
+    recently used (ngrid, sampling) pairs being released once the cache
+    exceeds max_bytes.
+
+    Parameters
+    ----------
+    ngrid : int
+        Size of the (square) grid
+
+    sampling : float
+        Grid sampling in metres
+
+    name : str
+        'x', 'y', 'r2' (radius squared), 'r' or 'phi' (atan2(y, x)) for 2D
+        grids in centred order; 'x1d' for the 1D coordinates along either
+        axis in centred order, or 'x1d_shifted' in PROPER wavefront array
+        order (centre at index 0)
+
+    Returns
+    -------
+    grid : numpy ndarray
+        Read-only coordinates in metres (radians for phi)
+    """
+    key = (int(ngrid), float(sampling))
+    if key in _grids:
+        _grids.move_to_end(key)
+    else:
+        _grids[key] = {}
+        _sizes[key] = 0
+    entry = _grids[key]
+    if name not in entry:
+        grid = _build(ngrid, sampling, name)
+        grid.flags.writeable = False
+        entry[name] = grid
+        # Views (e.g. the broadcast x and y) share memory with x1d
+        if grid.base is None:
+            _sizes[key] += grid.nbytes
+            _evict(key)
+    return entry[name]
+
+def _evict(keep):
+    # Release least recently used pairs, other than keep, until within max_bytes
+    for key in list(_grids):
+        if sum(_sizes.values()) <= max_bytes:
+            return
+        if key != keep:
+            del _grids[key]
+            del _sizes[key]
+
+def coordinates_bytes():
+    """Total size of the cached coordinate grids"""
+    return sum(_sizes.values())
+
+def clear_coordinates():
+    """Release all cached coordinate grids"""
+    _grids.clear()
+    _sizes.clear()
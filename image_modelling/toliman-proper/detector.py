@@ -0,0 +1,229 @@
+import numpy as np
+
+def pixel_kernel(oversample, sensitivity=None):
+    """Weights integrating oversampled PSF samples over one detector pixel
+
+    Pixel i is centred on sample i*oversample, as for fix_prop_pixellate
+    and PROPER grids, so for even oversampling the samples on the pixel
+    edges are shared between neighbours and carry half weight.
+
+    Parameters
+    ----------
+    oversample : int
+        PSF samples per detector pixel
+
+    sensitivity : function or numpy ndarray
+        Intra-pixel sensitivity along one axis, either a function of the
+        position u within the pixel (-0.5 to 0.5) or its values at each
+        sample. It is normalised to a mean of 1 over the pixel. Default is
+        uniform.
+
+    Returns
+    -------
+    kernel : numpy ndarray
+        Weights of the 2*(oversample//2)+1 (or oversample, if odd) samples
+        about the pixel centre, summing to oversample
+    """
+    half = oversample//2
+    offsets = np.arange(-half, half + 1)
+    weights = np.where(np.abs(offsets) < oversample/2., 1., 0.5)
+    if sensitivity is not None:
+        if callable(sensitivity):
+            s = np.asarray(sensitivity(offsets/float(oversample)), dtype = np.float64)
+        else:
+            s = np.asarray(sensitivity, dtype = np.float64)
+        weights = weights * s * (np.sum(weights) / np.sum(weights * s))
+    return weights
+
+def diffusion_kernel(oversample, sigma, truncate=4.):
+    """Gaussian charge diffusion kernel at the PSF sampling
+
+    Parameters
+    ----------
+    oversample : int
+        PSF samples per detector pixel
+
+    sigma : float
+        Diffusion length (standard deviation) in detector pixels
+
+    truncate : float
+        Kernel half-width in standard deviations
+
+    Returns
+    -------
+    kernel : numpy ndarray
+        Normalised weights of an odd number of samples about zero
+    """
+    sigma = sigma * oversample
+    if sigma <= 0.:
+        return np.ones(1)
+    half = int(np.ceil(truncate * sigma))
+    x = np.arange(-half, half + 1)
+    kernel = np.exp(-0.5 * (x/sigma)**2)
+    return kernel / np.sum(kernel)
+
+def detector_model(oversample, sensitivity=None, diffusion=0., flat=None, threshold=1e-4, tile=16):
+    """Precompute the response of a detector, for detector_response
+
+    The response of each axis is the intra-pixel sensitivity profile
+    convolved with the charge diffusion kernel, so the full response is
+    separable and is built once for all the images of a study.
+
+    Parameters
+    ----------
+    oversample : int
+        PSF samples per detector pixel, e.g. 2 for the Nyquist PSF of
+        form_psf
+
+    sensitivity : function, numpy ndarray or tuple
+        Intra-pixel sensitivity as for pixel_kernel, or a (row, column)
+        pair of them. Default is uniform.
+
+    diffusion : float
+        Charge diffusion length (standard deviation) in detector pixels
+
+    flat : numpy ndarray or float
+        Per-pixel quantum efficiency and flat field, multiplying the image
+
+    threshold : float
+        Tiles whose brightest pixel is below this fraction of the image peak
+        are only binned onto pixels, without the sensitivity and diffusion
+
+    tile : int
+        Size in pixels of the tiles in which the full response is evaluated
+
+    Returns
+    -------
+    model : dict
+        Detector model for detector_response
+    """
+    if not isinstance(sensitivity, tuple):
+        sensitivity = (sensitivity, sensitivity)
+    g = diffusion_kernel(oversample, diffusion)
+    kernels = [np.convolve(pixel_kernel(oversample, s), g) for s in sensitivity]
+    # Both start oversample//2 + len(g)//2 samples before the pixel centre
+    pad = oversample//2 + len(g)//2
+    return {'oversample': oversample,
+            'kernels': kernels,
+            'plain': pixel_kernel(oversample),
+            'pad': pad,
+            'flat': flat,
+            'threshold': threshold,
+            'tile': tile}
+
+def _bin(samples, kernel, oversample, n, axis):
+    # out[i] = sum_a kernel[a] * samples[i*oversample + a] along axis
+    out = 0.
+    for a, w in enumerate(kernel):
+        index = [slice(None)] * samples.ndim
+        index[axis] = slice(a, a + (n - 1)*oversample + 1, oversample)
+        out = out + w * samples[tuple(index)]
+    return out
+
+def significant_tiles(image, threshold, tile):
+    """Tiles of an image holding pixels brighter than threshold of its peak,
+    and their neighbours
+
+    Neighbouring tiles are included so that flux spread out of a bright tile
+    (e.g. by charge diffusion) is kept.
+
+    Returns
+    -------
+    tiles : list of tuple
+        (row, column) pixel origin of each significant tile
+    """
+    n = image.shape[0]
+    nt = -(-n // tile)
+    padded = np.zeros((nt*tile, nt*tile), dtype = image.dtype)
+    padded[:n, :n] = image
+    peaks = padded.reshape(nt, tile, nt, tile).max(axis=(1, 3))
+    bright = np.pad(peaks >= threshold * np.max(image), 1)
+    # Dilate by one tile
+    mask = np.zeros((nt, nt), dtype = bool)
+    for dr in range(3):
+        for dc in range(3):
+            mask |= bright[dr:dr+nt, dc:dc+nt]
+    rows, cols = np.nonzero(mask)
+    return [(r*tile, c*tile) for r, c in zip(rows, cols)]
+
+def detector_response(psf, model, npixels=None):
+    """Integrate an oversampled PSF onto detector pixels with a detector model
+
+    The PSF is first binned onto pixels, which is cheap, and the full
+    response (intra-pixel sensitivity and charge diffusion) is then
+    evaluated only in the tiles where that image is significant and their
+    neighbours, so the cost follows the footprint of the signal rather than
+    the image size. Other tiles keep the binned values. Flux is conserved
+    unless diffusion carries it more than a tile beyond the significant
+    tiles, or out of the image.
+
+    Parameters
+    ----------
+    psf : numpy ndarray
+        2D PSF sampled at model['oversample'] samples per pixel, centred
+        as for PROPER (e.g. from form_psf)
+
+    model : dict
+        From detector_model
+
+    npixels : int
+        Size of the detector. Default is the PSF size / oversample.
+
+    Returns
+    -------
+    image : numpy ndarray
+        2D detector image
+    """
+    k = model['oversample']
+    pad = model['pad']
+    if npixels is None:
+        npixels = psf.shape[0] // k
+    # Pad so that every kernel lies within the array, and offset so that
+    # pixel npixels//2 is centred on sample psf.shape[0]//2
+    offset = psf.shape[0]//2 - (npixels//2)*k
+    size = (npixels - 1)*k + 1 + 2*pad
+    samples = np.zeros((size, size), dtype = np.float64)
+    lo = pad - offset
+    src = slice(max(0, -lo), min(psf.shape[0], size - lo))
+    dst = slice(src.start + lo, src.stop + lo)
+    samples[dst, dst] = psf[src, src]
+
+    plain = model['plain']
+    start = pad - len(plain)//2
+    binned = samples[start:size - start, start:size - start]
+    image = _bin(_bin(binned, plain, k, npixels, 0), plain, k, npixels, 1)
+
+    tile = model['tile']
+    row_kernel, col_kernel = model['kernels']
+    for r0, c0 in significant_tiles(image, model['threshold'], tile):
+        nr = min(tile, npixels - r0)
+        nc = min(tile, npixels - c0)
+        block = samples[r0*k:r0*k + (nr - 1)*k + len(row_kernel),
+                        c0*k:c0*k + (nc - 1)*k + len(col_kernel)]
+        image[r0:r0+nr, c0:c0+nc] = _bin(_bin(block, row_kernel, k, nr, 0), col_kernel, k, nc, 1)
+
+    if model['flat'] is not None:
+        image *= model['flat']
+    return image
+
+def form_detector_response(prescription, sources, gridsize, detector_pitch, npixels, model, multi=True):
+    """Form a detector image, as form_detector_image, with a detector model
+
+    Parameters
+    ----------
+    prescription, sources, gridsize, detector_pitch, npixels, multi :
+        As for proper_tools.form_detector_image
+
+    model : dict
+        From detector_model. npixels*oversample must be even.
+
+    Returns
+    -------
+    image : numpy ndarray
+        2D detector image of dimension npixels
+    """
+    from proper_tools import form_psf
+    k = model['oversample']
+    # form_psf samples at half its detector_pitch
+    psf = form_psf(prescription, sources, gridsize, 2.*detector_pitch/k, npixels*k//2, multi=multi)
+    return detector_response(psf, model, npixels)
@@ -1,7 +1,8 @@
 import math
 import numpy as np
+from coordinates import coordinates
 
-def gen_opdmap(opd_func, ngrid, sampling):
+def gen_opdmap(opd_func, ngrid, sampling, rmax=None):
     """Generate the OPD map for a phase pupil
     
     Parameters
@@ -15,6 +16,10 @@ def gen_opdmap(opd_func, ngrid, sampling):
     sampling : float
         Sampling distance for grid, in metres
     
+    rmax : float
+        Optional radius in metres beyond which the OPD is taken as zero, 
+        e.g. the pupil radius; only pixels within the enclosing box are 
+        evaluated.
         
     Returns
     -------
@@ -23,13 +28,21 @@ def gen_opdmap(opd_func, ngrid, sampling):
     """
     
     opd_map = np.zeros([ngrid, ngrid], dtype = np.float64)
-    c = ngrid/2.
-    for i in range(ngrid):
-        for j in range(ngrid):
-            x = i - c
-            y = j - c
-            phi = math.atan2(y, x)
-            r = sampling*math.hypot(x,y)
-            opd_map[i][j] = opd_func(r, phi)
+    c = ngrid//2 # PROPER centre pixel, for any even or odd size
+    lo = 0
+    hi = ngrid
+    if rmax is not None:
+        half = int(math.ceil(rmax/sampling)) + 1
+        lo = max(0, c - half)
+        hi = min(ngrid, c + half + 1)
+    # Python lists of the shared coordinates are fastest for scalar calls
+    r = coordinates(ngrid, sampling, 'r')[lo:hi, lo:hi].tolist()
+    phi = coordinates(ngrid, sampling, 'phi')[lo:hi, lo:hi].tolist()
+    for i in range(hi - lo):
+        r_i = r[i]
+        phi_i = phi[i]
+        row = opd_map[lo + i]
+        for j in range(hi - lo):
+            row[lo + j] = opd_func(r_i[j], phi_i[j])
         
     return opd_map
\ No newline at end of file
@@ -0,0 +1,81 @@
+# Check that modules used by worker processes and command-line tools import
+# quickly, and without pulling in heavy optional dependencies.
+import subprocess
+import sys
+import json
+import os
+
+# Largest acceptable import time in seconds, including numpy
+IMPORT_BUDGETS = {
+                  'cache_storage': 0.5,
+                  'coordinates': 0.5,
+                  'proper_cache': 0.5,
+                  'proper_tools': 0.5,
+                  'sweep': 0.5,
+                  'warmup': 0.5,
+                  'jitter': 0.5,
+                  'spectral': 0.5,
+                  'chromatic': 0.5,
+                  'convergence': 0.5,
+                  'zemax_compare': 0.5,
+                  'zernike': 0.5,
+                  'job_service': 0.5,
+                  'resource_model': 0.5,
+                  'work_queue': 0.5,
+                  'stack_analysis': 0.5,
+                  'telescope': 0.5,
+                  'detector': 0.5,
+                  'psf_cube': 0.5,
+                  }
+
+# Dependencies that must only be imported when actually used
+HEAVY_MODULES = ('proper', 'matplotlib', 'pyfftw', 'poppy', 'astropy', 'scipy')
+
+# Run in a fresh interpreter; lazily imported modules only enter sys.modules
+# once used
+_probe = '''
+import sys, time, json
+start = time.perf_counter()
+import {}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {!r} if m in sys.modules]
+print(json.dumps({{'time': elapsed, 'heavy': heavy}}))
+'''
+
+def measure_import(module, repeats=3):
+    """Time importing a module in fresh interpreters
+
+    Parameters
+    ----------
+    module : str
+        Module name
+
+    repeats : int
+        Number of fresh interpreters to time; the fastest is reported
+
+    Returns
+    -------
+    elapsed : float
+        Import time in seconds
+
+    heavy : list of str
+        Heavy dependencies actually loaded by the import
+    """
+    best = None
+    for i in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', _probe.format(module, HEAVY_MODULES)],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        result = json.loads(out.decode().strip().splitlines()[-1])
+        if best is None or result['time'] < best['time']:
+            best = result
+    return best['time'], best['heavy']
+
+if __name__ == '__main__':
+    failed = False
+    for module, budget in sorted(IMPORT_BUDGETS.items()):
+        elapsed, heavy = measure_import(module)
+        ok = elapsed <= budget and len(heavy) == 0
+        failed = failed or not ok
+        print('{:<16} {:6.3f}s (budget {:.3f}s) {}{}'.format(module, elapsed, budget, 'ok' if ok else 'FAIL',
+                                                            ' loads ' + ', '.join(heavy) if heavy else ''))
+    sys.exit(1 if failed else 0)
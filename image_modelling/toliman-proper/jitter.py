@@ -0,0 +1,203 @@
+import numpy as np
+from numpy.fft import fft2, ifft2, fftfreq
+from proper_tools import form_psf, fix_prop_pixellate
+
+def centroid(image):
+    """Flux-weighted centroid of a 2D image
+
+    Parameters
+    ----------
+    image : numpy ndarray
+        2D image
+
+    Returns
+    -------
+    out : numpy ndarray
+        Centroid as (row, column), in pixels
+    """
+    total = np.sum(image)
+    rows = np.sum(image, axis=1)
+    cols = np.sum(image, axis=0)
+    return np.array([np.dot(np.arange(rows.size), rows)/total,
+                     np.dot(np.arange(cols.size), cols)/total])
+
+def calibrate_plate_scale(prescription, sources, gridsize, detector_pitch, npixels, delta=0.01, multi=True):
+    """Measure the focal-plane shift produced by a change in pointing
+
+    The PSF is formed on-axis and with each source tilted by delta along x and
+    then y. The centroid shifts give the mapping from tilt to position on the
+    Nyquist-sampled PSF grid returned by form_psf, including its orientation
+    and sign. This costs three propagations and only needs doing once per
+    optical configuration.
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+
+    sources : list of dict
+        Sources as passed to form_detector_image
+
+    gridsize, detector_pitch, npixels, multi :
+        As for form_detector_image
+
+    delta : float
+        Tilt offset used for the calibration, in arc seconds
+
+    Returns
+    -------
+    plate_scale : numpy ndarray
+        2x2 matrix mapping (tilt_x, tilt_y) in arc seconds to (row, column)
+        shift in PSF pixels
+    """
+    ref = centroid(form_psf(prescription, sources, gridsize, detector_pitch, npixels, multi=multi))
+    plate_scale = np.zeros((2, 2), dtype = np.float64)
+    for axis, key in enumerate(['tilt_x', 'tilt_y']):
+        tilted_sources = []
+        for source in sources:
+            tilted = source.copy()
+            tilted['settings'] = source['settings'].copy()
+            tilted['settings'][key] = tilted['settings'].get(key, 0.) + delta
+            tilted_sources.append(tilted)
+        shifted = centroid(form_psf(prescription, tilted_sources, gridsize, detector_pitch, npixels, multi=multi))
+        plate_scale[:, axis] = (shifted - ref)/delta
+    return plate_scale
+
+def sample_durations(t):
+    """Time represented by each sample of a trace
+
+    Each sample is taken to hold until the next one; the last sample is given
+    the same duration as the one before it.
+
+    Parameters
+    ----------
+    t : numpy ndarray
+        Sample times in seconds, increasing
+
+    Returns
+    -------
+    dt : numpy ndarray
+        Duration of each sample in seconds
+    """
+    t = np.asarray(t, dtype = np.float64)
+    if t.size < 2:
+        return np.ones(t.size)
+    dt = np.empty(t.size)
+    dt[:-1] = np.diff(t)
+    dt[-1] = dt[-2]
+    return dt
+
+def jitter_kernel_ft(shifts, weights, n, method='deposit', chunk=4096):
+    """Fourier transform of a pointing jitter kernel
+
+    Parameters
+    ----------
+    shifts : numpy ndarray
+        Array of shape (nsamples, 2) giving (row, column) shifts in pixels
+
+    weights : numpy ndarray
+        Weight (usually duration) of each sample
+
+    n : int
+        Dimension of the (square) image the kernel is applied to
+
+    method : str
+        'deposit' spreads each sample over the four nearest pixels of a
+        kernel image and compensates for the bilinear spreading in Fourier
+        space. The cost is O(nsamples) plus one FFT, so is suited to long,
+        densely sampled traces.
+        'exact' sums the shift phasors of every sample, which is exact for any
+        sub-pixel shift but costs O(nsamples * n**2) (as matrix products).
+
+    chunk : int
+        Number of samples per matrix product for the 'exact' method
+
+    Returns
+    -------
+    kernel_ft : numpy ndarray
+        Complex n by n array in FFT order
+    """
+    shifts = np.asarray(shifts, dtype = np.float64)
+    weights = np.asarray(weights, dtype = np.float64)
+    freq = fftfreq(n)
+    if method == 'deposit':
+        base = np.floor(shifts)
+        frac = shifts - base
+        i0 = base[:,0].astype(int) % n
+        j0 = base[:,1].astype(int) % n
+        i1 = (i0 + 1) % n
+        j1 = (j0 + 1) % n
+        kernel = np.zeros((n, n), dtype = np.float64)
+        np.add.at(kernel, (i0, j0), weights*(1. - frac[:,0])*(1. - frac[:,1]))
+        np.add.at(kernel, (i1, j0), weights*frac[:,0]*(1. - frac[:,1]))
+        np.add.at(kernel, (i0, j1), weights*(1. - frac[:,0])*frac[:,1])
+        np.add.at(kernel, (i1, j1), weights*frac[:,0]*frac[:,1])
+        # Bilinear deposition is a convolution with a one pixel tent, whose
+        # transfer function is sinc**2; this is non-zero within the band.
+        tent = np.sinc(freq)**2
+        return fft2(kernel) / np.dot(tent[:,np.newaxis], tent[np.newaxis,:])
+    elif method == 'exact':
+        kernel_ft = np.zeros((n, n), dtype = np.complex128)
+        for start in range(0, len(weights), chunk):
+            s = shifts[start:start+chunk]
+            w = weights[start:start+chunk]
+            phasor_r = np.exp(-2j*np.pi*np.outer(s[:,0], freq))
+            phasor_c = np.exp(-2j*np.pi*np.outer(s[:,1], freq))
+            kernel_ft += np.dot((phasor_r * w[:,np.newaxis]).T, phasor_c)
+        return kernel_ft
+    else:
+        raise ValueError('Unknown jitter method "{}"'.format(method))
+
+def jitter_exposures(psf, trace, plate_scale, detector_pitch, exposure_time=None, method='deposit'):
+    """Integrate a PSF over a pointing jitter trace without re-propagation
+
+    The PSF is shifted by each pointing sample and summed, weighted by the
+    sample duration, via a single jitter kernel per exposure applied in
+    Fourier space. The result is then integrated onto detector pixels as in
+    form_detector_image. Once the PSF exists the cost depends only on the PSF
+    size and trace length, not on the propagation gridsize.
+
+    Parameters
+    ----------
+    psf : numpy ndarray
+        Nyquist-sampled PSF, as returned by form_psf
+
+    trace : numpy ndarray
+        Array of shape (nsamples, 3), with columns tilt_x, tilt_y (arc
+        seconds) and t (seconds)
+
+    plate_scale : numpy ndarray
+        2x2 matrix mapping tilt to PSF pixels, from calibrate_plate_scale
+
+    detector_pitch : float
+        Size of detector pixels in metres
+
+    exposure_time : float
+        Length of each exposure in seconds. If None the whole trace is
+        integrated as a single exposure.
+
+    method : str
+        Kernel method, 'deposit' or 'exact'; see jitter_kernel_ft
+
+    Returns
+    -------
+    out : numpy ndarray
+        Stack of detector images, one per exposure
+    """
+    trace = np.asarray(trace, dtype = np.float64)
+    n = psf.shape[0]
+    t = trace[:,2]
+    weights = sample_durations(t)
+    shifts = np.dot(trace[:,:2], np.asarray(plate_scale).T)
+    if exposure_time is None:
+        frame = np.zeros(t.size, dtype = int)
+    else:
+        frame = np.floor((t - t[0]) / exposure_time).astype(int)
+    psf_ft = fft2(psf)
+    exposures = []
+    for i in range(frame.max() + 1):
+        sel = frame == i
+        kernel_ft = jitter_kernel_ft(shifts[sel], weights[sel], n, method)
+        smeared = np.real(ifft2(psf_ft * kernel_ft))
+        exposures.append(fix_prop_pixellate(smeared, detector_pitch/2., detector_pitch))
+    return np.stack(exposures)
@@ -0,0 +1,297 @@
+"""Local job service for form_detector_image, shared by several clients
+
+Usage: python job_service.py serve [--socket PATH] [--processes N]
+       python job_service.py stats [--socket PATH]
+
+The server listens on a Unix socket and runs requests on a pool of worker
+processes. Requests are identified by a hash of their content, so a request
+identical to one in flight waits for that job, and one identical to a recent
+job is answered at once. Images are returned through shared memory.
+
+In a notebook:
+
+    from job_service import JobClient
+    image = JobClient().form_detector_image('prescription_rc_quad', sources,
+                                            2048, 11e-6, 512)
+"""
+import argparse
+import asyncio
+import functools
+import hashlib
+import json
+import marshal
+import os
+import pickle
+import socket
+import struct
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# Unix socket of the service; only processes of users with access to it can
+# submit jobs
+socket_path = os.environ.get('TOLIMAN_JOB_SOCKET', '/tmp/toliman-jobs-{}.sock'.format(os.getuid()))
+
+_header = struct.Struct('!Q')
+
+def _setting_key(value):
+    # Settings are keyed by content, so different values never share a hash
+    if isinstance(value, np.ndarray):
+        data = np.ascontiguousarray(value)
+        return {'array': hashlib.sha1(data.tobytes()).hexdigest(), 'dtype': data.dtype.str, 'shape': data.shape}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, functools.partial):
+        return {'partial': value.func, 'args': list(value.args), 'kwargs': value.keywords}
+    if isinstance(value, types.FunctionType):
+        # Module-level functions (e.g. opd_func) are found again by name, so
+        # their code identifies them; lambdas and local functions may depend
+        # on state that cannot be seen here
+        name = '{}.{}'.format(value.__module__, value.__qualname__)
+        if value.__module__ == '__main__' or '<' in value.__qualname__:
+            raise TypeError('Function {} cannot be identified by content; define it in a module'.format(name))
+        return {'function': name, 'code': hashlib.sha1(marshal.dumps(value.__code__)).hexdigest(),
+                'defaults': value.__defaults__, 'kwdefaults': value.__kwdefaults__}
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    raise TypeError('Setting {!r} of type {} cannot be identified by content'.format(value, type(value).__name__))
+
+def request_hash(request):
+    """Hash identifying the image a request would produce
+
+    Parameters
+    ----------
+    request : dict
+        'prescription', 'sources', 'gridsize', 'detector_pitch', 'npixels'
+        and 'multi', as for form_detector_image
+
+    Returns
+    -------
+    digest : str
+        Hex digest, the same for requests with the same content
+
+    Raises
+    ------
+    TypeError
+        If a setting cannot be identified by its content, e.g. a lambda
+    """
+    content = json.dumps(request, sort_keys=True, default=_setting_key)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+def _run_job(request):
+    from proper_tools import form_detector_image
+    return form_detector_image(request['prescription'], request['sources'], request['gridsize'],
+                               request['detector_pitch'], request['npixels'], multi=request['multi'])
+
+async def _read_message(reader):
+    (size,) = _header.unpack(await reader.readexactly(_header.size))
+    return await reader.readexactly(size)
+
+def _write_message(writer, message):
+    data = pickle.dumps(message)
+    writer.write(_header.pack(len(data)) + data)
+
+class JobServer:
+    """Deduplicating form_detector_image service
+
+    Parameters
+    ----------
+    path : str
+        Unix socket to listen on
+
+    processes : int
+        Number of worker processes. Default is the number of CPUs.
+
+    max_results : int
+        Number of completed images kept in shared memory for repeat requests
+    """
+    def __init__(self, path=None, processes=None, max_results=64):
+        self.path = path or socket_path
+        self.processes = processes or os.cpu_count()
+        self.max_results = max_results
+        self.executor = None
+        # Jobs in flight, and shared memory of completed results, by hash
+        self.pending = {}
+        self.results = OrderedDict()
+        self.counts = {'requests': 0, 'computed': 0, 'deduplicated': 0, 'cached': 0, 'failed': 0}
+        self.started = time.time()
+        self.busy_time = 0.
+
+    def stats(self):
+        """Queue depth, throughput and deduplication counts"""
+        elapsed = time.time() - self.started
+        stats = {'in_flight': len(self.pending),
+                 'queue_depth': max(0, len(self.pending) - self.processes),
+                 'workers': self.processes,
+                 'results_held': len(self.results),
+                 'uptime': elapsed,
+                 'throughput': self.counts['computed'] / elapsed if elapsed > 0 else 0.,
+                 'mean_job_time': self.busy_time / self.counts['computed'] if self.counts['computed'] else None}
+        stats.update(self.counts)
+        return stats
+
+    def _store(self, digest, image):
+        shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[...] = image
+        self.results[digest] = (shm, image.shape, image.dtype.str)
+        while len(self.results) > self.max_results:
+            old, _, _ = self.results.popitem(last=False)[1]
+            old.close()
+            old.unlink()
+
+    def _reply(self, digest):
+        shm, shape, dtype = self.results[digest]
+        self.results.move_to_end(digest)
+        return {'hash': digest, 'shm': shm.name, 'shape': shape, 'dtype': dtype}
+
+    async def _compute(self, digest, request):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            image = await loop.run_in_executor(self.executor, _run_job, request)
+        finally:
+            del self.pending[digest]
+        self.busy_time += time.time() - start
+        self.counts['computed'] += 1
+        self._store(digest, image)
+        # Reply now, as the result may be evicted before waiters resume
+        return self._reply(digest)
+
+    async def _submit(self, request):
+        digest = request_hash(request)
+        self.counts['requests'] += 1
+        if digest in self.results:
+            self.counts['cached'] += 1
+            return self._reply(digest)
+        if digest in self.pending:
+            self.counts['deduplicated'] += 1
+        else:
+            self.pending[digest] = asyncio.ensure_future(self._compute(digest, request))
+        # Shielded, so a client disconnecting doesn't cancel a shared job
+        return await asyncio.shield(self.pending[digest])
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    data = await _read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                # Every message gets a reply, so a client never waits forever
+                try:
+                    message = pickle.loads(data)
+                    if message.get('command') == 'stats':
+                        reply = self.stats()
+                    else:
+                        reply = await self._submit(message['request'])
+                except Exception as e:
+                    self.counts['failed'] += 1
+                    reply = {'error': '{}: {}'.format(type(e).__name__, e)}
+                _write_message(writer, reply)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """Serve requests until cancelled"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+        # Create the socket private to this user from the start, as requests
+        # are unpickled
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self._handle, path=self.path)
+        finally:
+            os.umask(umask)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown()
+            for shm, _, _ in self.results.values():
+                shm.close()
+                shm.unlink()
+            self.results.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+def _attach(name):
+    # Attach without this process's resource tracker taking ownership, which
+    # would unlink the server's memory when this process exits
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+class JobClient:
+    """Client for a JobServer
+
+    Parameters
+    ----------
+    path : str
+        Unix socket of the server
+    """
+    def __init__(self, path=None):
+        self.path = path or socket_path
+
+    def _call(self, message):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(self.path)
+            data = pickle.dumps(message)
+            s.sendall(_header.pack(len(data)) + data)
+            with s.makefile('rb') as f:
+                (size,) = _header.unpack(f.read(_header.size))
+                reply = pickle.loads(f.read(size))
+        if 'error' in reply:
+            raise RuntimeError('Job failed: {}'.format(reply['error']))
+        return reply
+
+    def stats(self):
+        """Server statistics, see JobServer.stats"""
+        return self._call({'command': 'stats'})
+
+    def form_detector_image(self, prescription, sources, gridsize, detector_pitch, npixels, multi=False):
+        """As proper_tools.form_detector_image, computed (or found) by the server
+
+        multi defaults to False, as the server already runs jobs in parallel.
+        """
+        request = {'prescription': prescription, 'sources': sources, 'gridsize': gridsize,
+                   'detector_pitch': detector_pitch, 'npixels': npixels, 'multi': multi}
+        for attempt in range(2):
+            reply = self._call({'request': request})
+            try:
+                shm = _attach(reply['shm'])
+            except FileNotFoundError:
+                # Evicted between reply and attach; the retry recomputes it
+                continue
+            try:
+                return np.ndarray(reply['shape'], dtype=reply['dtype'], buffer=shm.buf).copy()
+            finally:
+                shm.close()
+        raise RuntimeError('Result {} was evicted before it could be read'.format(reply['hash']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local form_detector_image job service')
+    parser.add_argument('command', choices=['serve', 'stats'])
+    parser.add_argument('--socket', default=socket_path, help='Unix socket path')
+    parser.add_argument('--processes', type=int, help='worker processes (default: number of CPUs)')
+    parser.add_argument('--max-results', type=int, default=64, help='completed images kept for repeat requests')
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        server = JobServer(args.socket, args.processes, args.max_results)
+        try:
+            asyncio.run(server.serve())
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(json.dumps(JobClient(args.socket).stats(), indent=1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import importlib
+import importlib.util
+import sys
+import threading
+
+class _LazyModule(object):
+    # Stands in for a module until first used, then imports it normally.
+    # Nothing is placed in sys.modules until the real import, so other
+    # imports never see a half-initialised module, and the lock makes the
+    # first use safe from several threads.
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_module', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                module = self._module
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    object.__setattr__(self, '_module', module)
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        if self._module is None:
+            return '<lazy module {!r}>'.format(self._name)
+        return repr(self._module)
+
+def lazy_import(name):
+    """Import a module on first use rather than now
+
+    Lets modules refer to heavy or optional dependencies (e.g. proper,
+    matplotlib, poppy) at the top level without paying their import cost,
+    or requiring them, until one of their attributes is used. This keeps
+    start-up fast for worker processes and command-line tools.
+
+    Parameters
+    ----------
+    name : str
+        Full name of the module
+
+    Returns
+    -------
+    module : module
+        The module if already imported, otherwise a proxy that imports it
+        on first attribute access
+
+    Raises
+    ------
+    ImportError
+        If the module cannot be found
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    if importlib.util.find_spec(name) is None:
+        raise ImportError('No module named {}'.format(name))
+    return _LazyModule(name)
@@ -1,7 +1,6 @@
 import proper
 import math
 import numpy as np
-import matplotlib.pyplot as plt
 from prop_tilt import prop_tilt
 from gen_opdmap import gen_opdmap
 
@@ -7,26 +7,30 @@ from gen_opdmap import gen_opdmap
 from build_prop_circular_aperture import build_prop_circular_aperture
 from build_prop_circular_obscuration import build_prop_circular_obscuration
 from build_prop_rectangular_obscuration import build_prop_rectangular_obscuration
-from build_phase_map import build_phase_map
-from proper_cache import load_cacheable_grid
+from pupil_support import load_cacheable_support, apply_support, apply_opd_support
+from zernike import zernike_support
+from telescope import TELESCOPE
 
 def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
     # Assign parameters from PASSVALUE struct or use defaults
-    diam           = PASSVALUE.get('diam',0.3)                    # telescope diameter in meters
-    m1_fl          = PASSVALUE.get('m1_fl',0.5717255)             # primary focal length (m)
-    m1_hole_rad    = PASSVALUE.get('m1_hole_rad',0.035)           # Radius of hole in primary (m)
-    m1_m2_sep      = PASSVALUE.get('m1_m2_sep',0.549337630333726) # primary to secondary separation (m)
-    m2_fl          = PASSVALUE.get('m2_fl',-0.023378959)          # secondary focal length (m)
-    bfl            = PASSVALUE.get('bfl',0.528110658881)          # nominal distance from secondary to focus (m)
-    beam_ratio     = PASSVALUE.get('beam_ratio',0.2)              # initial beam width/grid width
-    m2_rad         = PASSVALUE.get('m2_rad',0.059)                # Secondary half-diameter (m)
-    m2_strut_width = PASSVALUE.get('m2_strut_width',0.01)         # Width of struts supporting M2 (m)
-    m2_supports    = PASSVALUE.get('m2_supports',5)               # Number of support structs (assumed equally spaced)
+    diam           = PASSVALUE.get('diam',TELESCOPE['diam'])                     # telescope diameter in meters
+    m1_fl          = PASSVALUE.get('m1_fl',TELESCOPE['m1_fl'])                   # primary focal length (m)
+    m1_hole_rad    = PASSVALUE.get('m1_hole_rad',TELESCOPE['m1_hole_rad'])       # Radius of hole in primary (m)
+    m1_m2_sep      = PASSVALUE.get('m1_m2_sep',TELESCOPE['m1_m2_sep'])           # primary to secondary separation (m)
+    m2_fl          = PASSVALUE.get('m2_fl',TELESCOPE['m2_fl'])                   # secondary focal length (m)
+    bfl            = PASSVALUE.get('bfl',TELESCOPE['bfl'])                       # nominal distance from secondary to focus (m)
+    beam_ratio     = PASSVALUE.get('beam_ratio',TELESCOPE['beam_ratio'])         # initial beam width/grid width
+    m2_rad         = PASSVALUE.get('m2_rad',TELESCOPE['m2_rad'])                 # Secondary half-diameter (m)
+    m2_strut_width = PASSVALUE.get('m2_strut_width',TELESCOPE['m2_strut_width']) # Width of struts supporting M2 (m)
+    m2_supports    = PASSVALUE.get('m2_supports',TELESCOPE['m2_supports'])       # Number of support structs (assumed equally spaced)
     tilt_x         = PASSVALUE.get('tilt_x',0.)                   # Tilt angle along x (arc seconds)
     tilt_y         = PASSVALUE.get('tilt_y',0.)                   # Tilt angle along y (arc seconds)
     noabs          = PASSVALUE.get('noabs',False)                 # Output complex amplitude?
     use_caching    = PASSVALUE.get('use_caching',False)           # Use cached files if available?
+    sampling_wl    = PASSVALUE.get('sampling_wavelength',None)    # Wavelength (m) at which beam_ratio applies, if scaling with wavelength
     # Can also specify a opd_func function with signature opd_func(r, phi)
+    # and/or 'm1_zernike' and 'm2_zernike' lists of Zernike coefficients
+    # (Noll order from piston, metres RMS over each mirror)
     if 'phase_func' in PASSVALUE:
         print('DEPRECATED setting "phase_func": use "opd_func" instead')
         if 'opd_func' not in PASSVALUE:
@@ -37,14 +41,15 @@ def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
             PASSVALUE['opd_func_sec'] = PASSVALUE['phase_func_sec']
     
     
+    # Focal plane sampling is proportional to wavelength*beam_ratio, so scaling
+    # beam_ratio inversely with wavelength gives the same sampling for all
+    # wavelengths, and their PSFs can be summed without resampling.
+    if sampling_wl is not None:
+        beam_ratio *= sampling_wl / wavelength
+
     # Define the wavefront
     wfo = proper.prop_begin(diam, wavelength, gridsize, beam_ratio)
 
-# Disable state saving as by default this saves state even when not used.
-#    if proper.prop_is_statesaved(wfo) == False:
-    # Point off-axis
-    prop_tilt(wfo, tilt_x, tilt_y)
-
     def build_m2_obs():
         # Input aperture
         grid = build_prop_circular_aperture(wfo, diam/2)
@@ -66,7 +71,15 @@ def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
                                                 ROTATION = angle + 90)
         return grid
     
-    wfo.wfarr *= load_cacheable_grid('m2_obs', wfo, build_m2_obs, use_caching)
+    # Element-wise operations only touch the bounding box of each element's 
+    # support, which for the pupil is roughly beam_ratio**2 of the grid
+    entrance = load_cacheable_support('m2_obs', wfo, build_m2_obs, use_caching, outside=0.)
+    apply_support(wfo, entrance)
+
+# Disable state saving as by default this saves state even when not used.
+#    if proper.prop_is_statesaved(wfo) == False:
+    # Point off-axis; the wavefront is now zero outside the entrance support
+    prop_tilt(wfo, tilt_x, tilt_y, support=entrance)
     
     # Normalize wavefront
     proper.prop_define_entrance(wfo)
@@ -76,23 +89,30 @@ def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
     if 'opd_func' in PASSVALUE:
         opd1_func = PASSVALUE['opd_func']        
         def build_m1_opd():
-            return gen_opdmap(opd1_func, proper.prop_get_gridsize(wfo), proper.prop_get_sampling(wfo))
-        # TODO: Could also cache the phase map
-        wfo.wfarr *= build_phase_map(wfo, load_cacheable_grid(opd1_func.__name__, wfo, build_m1_opd, use_caching))
+            # The OPD is only evaluated over the pupil
+            return gen_opdmap(opd1_func, proper.prop_get_gridsize(wfo), proper.prop_get_sampling(wfo), rmax=diam/2)
+        apply_opd_support(wfo, load_cacheable_support(opd1_func.__name__, wfo, build_m1_opd, use_caching, outside=0., centred=True))
+    if 'm1_zernike' in PASSVALUE:
+        # Only the basis is cached, so each new set of coefficients is cheap
+        apply_opd_support(wfo, zernike_support(wfo, PASSVALUE['m1_zernike'], diam/2, use_caching))
     if 'm1_conic' in PASSVALUE:
         prop_conic(wfo, m1_fl, PASSVALUE['m1_conic'], "conic primary")
     else:
         proper.prop_lens(wfo, m1_fl, "primary")
-    wfo.wfarr *= build_prop_circular_obscuration(wfo, m1_hole_rad)
+    def build_m1_obs():
+        return build_prop_circular_obscuration(wfo, m1_hole_rad)
+    apply_support(wfo, load_cacheable_support('m1_obs_{}'.format(m1_hole_rad), wfo, build_m1_obs, use_caching))
 
     # Secondary mirror
     proper.prop_propagate(wfo, m1_m2_sep, "secondary")
     if 'opd_func_sec' in PASSVALUE:
         opd2_func = PASSVALUE['opd_func_sec']
         def build_m2_opd():
-            return gen_opdmap(opd2_func, proper.prop_get_gridsize(wfo), proper.prop_get_sampling(wfo))
-        # TODO: Could also cache the phase map
-        wfo.wfarr *= build_phase_map(wfo, load_cacheable_grid(opd2_func.__name__, wfo, build_m2_opd, use_caching))
+            # Beyond m2_rad the wavefront is removed by the M2 aperture below
+            return gen_opdmap(opd2_func, proper.prop_get_gridsize(wfo), proper.prop_get_sampling(wfo), rmax=m2_rad)
+        apply_opd_support(wfo, load_cacheable_support(opd2_func.__name__, wfo, build_m2_opd, use_caching, outside=0., centred=True))
+    if 'm2_zernike' in PASSVALUE:
+        apply_opd_support(wfo, zernike_support(wfo, PASSVALUE['m2_zernike'], m2_rad, use_caching))
         
     if 'm1_conic' in PASSVALUE:
         prop_conic(wfo, m2_fl, PASSVALUE['m2_conic'], "conic secondary")
@@ -101,7 +121,7 @@ def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
                 
     def build_m2_ap():
         return build_prop_circular_aperture(wfo, m2_rad)
-    wfo.wfarr *= load_cacheable_grid('m2_ap', wfo, build_m2_ap)
+    apply_support(wfo, load_cacheable_support('m2_ap', wfo, build_m2_ap, outside=0.))
 
 #    proper.prop_state(wfo)
 
@@ -110,7 +130,7 @@ def prescription_rc_quad(wavelength, gridsize, PASSVALUE = {}):
         proper.prop_propagate(wfo, m1_m2_sep, "M1 hole")
         def build_m1_hole():
             return build_prop_circular_aperture(wfo, m1_hole_rad) 
-        wfo.wfarr *= load_cacheable_grid('m1_hole', wfo, build_m1_hole)
+        apply_support(wfo, load_cacheable_support('m1_hole', wfo, build_m1_hole, outside=0.))
 
 
     # Focus - bfl can be varied between runs
@@ -1,6 +1,6 @@
 import proper
-import math
 import numpy as np
+from coordinates import coordinates
 
 
 def prop_conic(wf, lens_fl, conic, surface_name = ""):
@@ -102,10 +102,9 @@ def prop_conic(wf, lens_fl, conic, surface_name = ""):
         print("  LENS: R beam old = %s  R_beam = %s  lens_fl = %6.3f" %(sR_beam_old, sR_beam, lens_fl))
         print("  LENS: Beam diameter at lens = %4.3f" %(w_at_surface * 2))
     
-    # (BJ) Note this operation could be cached in WaveFront, and in any case this op
-    # wastefully calculates sqrt for each point, but each one gets squared prior to 
-    # passing to prop_add_phase below.
-    rho = proper.prop_radius(wf)
+    # Radius squared from the shared coordinate grids, in place of 
+    # proper.prop_radius(wf), which recalculates (and square roots) each time
+    rsq = coordinates(proper.prop_get_gridsize(wf), proper.prop_get_sampling(wf), 'r2')
     
     # For different propagator types
     if wf.propagator_type == "INSIDE__to_INSIDE_":
@@ -131,14 +130,12 @@ def prop_conic(wf, lens_fl, conic, surface_name = ""):
     # replaces the line:
     # proper.prop_add_phase(wf, -rho**2 * (lens_phase/2.))
     ### BEGIN ###
-    def conic_phase(r,k,phi):
-        rsq = r**2
-        return -rsq*phi/(1. + math.sqrt(1. - (1. + k)*rsq*(phi**2)))
-    conic_phase = np.vectorize(conic_phase)
-    calc_phase = conic_phase(rho, conic, 1./lens_fl)
+    def conic_phase(rsq,k,phi):
+        return -rsq*phi/(1. + np.sqrt(1. - (1. + k)*rsq*(phi**2)))
+    calc_phase = conic_phase(rsq, conic, 1./lens_fl)
 #    np.save("conic_phase_{}_{}.dat".format(lens_fl, conic), calc_phase)
     
-    quad_phase_corr = -rho**2 * ((lens_phase - 1./lens_fl) /2.)
+    quad_phase_corr = -rsq * ((lens_phase - 1./lens_fl) /2.)
 #    np.save("quad_phase_{}.dat".format(lens_fl), quad_phase)
     
     proper.prop_add_phase(wf, calc_phase+quad_phase_corr)
@@ -1,7 +1,8 @@
 import proper
 import numpy as np
+from coordinates import coordinates
 
-def prop_tilt(wf, tilt_x, tilt_y):
+def prop_tilt(wf, tilt_x, tilt_y, support=None):
     """Tilt a wavefront in X and Y.
     
     based on tilt(self, Xangle, Yangle) from Poppy (poppy_core.py)
@@ -22,6 +23,10 @@ def prop_tilt(wf, tilt_x, tilt_y):
     tilt_y : float
         Tilt angle along y in arc seconds
         
+    support : dict
+        Optional pupil support from pupil_support.grid_support. The wavefront
+        must be zero outside it, and only pixels within it are tilted.
+        
     Returns
     -------
         None
@@ -35,15 +40,22 @@ def prop_tilt(wf, tilt_x, tilt_y):
         yangle_rad = tilt_y *  np.pi / 648000. # rad.
         
         ngrid = proper.prop_get_gridsize(wf) # pixels
-        U, V = np.indices(wf.wfarr.shape, dtype=float)
-        U -= (ngrid - 1) / 2.0 # pixels X
-        U *= sampling # m
-        V -= (ngrid - 1) / 2.0 # pixels Y
-        V *= sampling # m
+        coords = coordinates(ngrid, sampling, 'x1d_shifted') # m, in wavefront array order
         
         # Not totally comfortable that these are combined linearly 
-        # but go with Poppy for now
-        phase = U * xangle_rad + V * yangle_rad  # rad. m
-        proper.prop_add_phase(wf, phase)
-        #tiltphasor = np.exp(2.0j * np.pi/wf.lamda * phase )
-        #wf.wfarr *= tiltphasor
\ No newline at end of file
+        # but go with Poppy for now.
+        # The linear phase is separable, so apply it as two 1D phasors, 
+        # along X (first axis) and Y (second axis), rather than a full grid 
+        # of exponentials.
+        k = 2.0 * np.pi / wf.lamda
+        if support is not None:
+            x_phasor = np.exp(1j * k * xangle_rad * coords[support['rows']])
+            y_phasor = np.exp(1j * k * yangle_rad * coords[support['cols']])
+            ix = np.ix_(support['rows'], support['cols'])
+            sub = wf.wfarr[ix]
+            sub *= x_phasor[:,np.newaxis]
+            sub *= y_phasor[np.newaxis,:]
+            wf.wfarr[ix] = sub
+        else:
+            wf.wfarr *= np.exp(1j * k * xangle_rad * coords)[:,np.newaxis]
+            wf.wfarr *= np.exp(1j * k * yangle_rad * coords)[np.newaxis,:]
@@ -1,6 +1,37 @@
-import numpy as np
-import proper
+from lazy_import import lazy_import
+proper = lazy_import('proper')
 import glob, os
+import fcntl
+import time
+from contextlib import contextmanager
+from cache_storage import load_grid, save_grid, grid_files, grid_name
+
+# Cache location and size limit; may be shared between processes and nodes.
+# Set from the environment or with set_cache_dir().
+cache_dir = os.environ.get('TOLIMAN_CACHE_DIR', '.')
+cache_max_bytes = int(os.environ.get('TOLIMAN_CACHE_MAX_BYTES', 0)) # 0 for no limit
+
+# Counts for this process, reported by cache_stats()
+cache_counts = {'hits': 0, 'misses': 0, 'waits': 0, 'evictions': 0}
+
+def set_cache_dir(path, max_bytes=None):
+    """Set the cache directory, and optionally its size limit
+
+    Parameters
+    ----------
+    path : str
+        Cache directory; created if needed
+
+    max_bytes : int
+        Total size above which least recently used entries are evicted, or 0
+        for no limit. Default leaves the current limit unchanged.
+    """
+    global cache_dir, cache_max_bytes
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    cache_dir = path
+    if max_bytes is not None:
+        cache_max_bytes = max_bytes
 
 def gen_cached_name(label, wfo):
     prefix = 'cached'
@@ -8,34 +39,189 @@ def gen_cached_name(label, wfo):
     ngrid = proper.prop_get_gridsize(wfo)
     beamradius = proper.prop_get_beamradius(wfo)
     sampling = proper.prop_get_sampling(wfo)
-    return '{}_{}_{}_{}_{}.npy'.format(prefix, label, ngrid, sampling, beamradius)
+    return os.path.join(cache_dir, '{}_{}_{}_{}_{}.npy'.format(prefix, label, ngrid, sampling, beamradius))
+
+@contextmanager
+def cache_lock(cached_name, blocking=True):
+    """Hold an exclusive lock on one cache entry
+
+    Uses an advisory lock on a lock file beside the entry, so works across
+    processes and (where the filesystem supports locking) nodes.
+
+    Parameters
+    ----------
+    cached_name : str
+        Path of the cache entry
+
+    blocking : bool
+        Wait for the lock if held elsewhere. Otherwise yield False immediately
+        rather than waiting.
+
+    Yields
+    ------
+    locked : bool
+        True if the lock is held
+    """
+    # The directory may come from TOLIMAN_CACHE_DIR without set_cache_dir
+    directory = os.path.dirname(cached_name)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(cached_name + '.lock', 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def cached_entries():
+    """List the entries in the cache directory
+
+    Returns
+    -------
+    entries : list of dict
+        For each entry, its 'name', total 'bytes', whether it is 'packed', and
+        'last_used' time (seconds since the epoch), least recently used first.
+    """
+    entries = {}
+    for f in glob.glob(os.path.join(cache_dir, 'cached*.npy')):
+        name = grid_name(f)
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        entry = entries.setdefault(name, {'name': name, 'bytes': 0, 'packed': False, 'last_used': 0.})
+        entry['bytes'] += st.st_size
+        entry['packed'] = entry['packed'] or f != name
+        entry['last_used'] = max(entry['last_used'], st.st_mtime)
+    return sorted(entries.values(), key=lambda e: e['last_used'])
+
+def _remove_entry(name):
+    for f in grid_files(name):
+        if os.path.exists(f):
+            os.remove(f)
 
 def clear_all_cached():
-    prefix = 'cached'
-    for f in glob.glob(prefix+"*.npy"):
-        print("Removing cached file {}".format(f))
+    for entry in cached_entries():
+        with cache_lock(entry['name']):
+            print("Removing cached file {}".format(entry['name']))
+            _remove_entry(entry['name'])
+    for f in glob.glob(os.path.join(cache_dir, 'cached*.npy.lock')):
         os.remove(f)
-    
+
+def evict_cached(max_bytes, keep=None):
+    """Remove least recently used entries until the cache fits in max_bytes
+
+    Entries currently locked by another process are skipped.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Size limit for the cache directory
+
+    keep : str
+        Name of an entry never to evict, e.g. one just written
+    """
+    entries = cached_entries()
+    total = sum(e['bytes'] for e in entries)
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        if entry['name'] == keep:
+            continue
+        with cache_lock(entry['name'], blocking=False) as locked:
+            if locked:
+                _remove_entry(entry['name'])
+                total -= entry['bytes']
+                cache_counts['evictions'] += 1
+
+def cache_stats():
+    """Summarise the cache directory and this process's use of it
+
+    Returns
+    -------
+    stats : dict
+        Cache directory, size limit, number of entries and total bytes,
+        bytes by label, and hit/miss/wait/eviction counts for this process.
+    """
+    entries = cached_entries()
+    by_label = {}
+    for entry in entries:
+        # Names are cached_<label>_<ngrid>_<sampling>_<beamradius>.npy
+        label = '_'.join(os.path.basename(entry['name']).split('_')[1:-3])
+        by_label[label] = by_label.get(label, 0) + entry['bytes']
+    stats = {'cache_dir': cache_dir,
+             'max_bytes': cache_max_bytes,
+             'entries': len(entries),
+             'bytes': sum(e['bytes'] for e in entries),
+             'packed': sum(1 for e in entries if e['packed']),
+             'bytes_by_label': by_label}
+    stats.update(cache_counts)
+    return stats
+
 def load_cached_grid(cached_name):
     try:
-        grid = np.load(cached_name)
-#        print("Found cached file {}".format(cached_name))       
+        grid = load_grid(cached_name)
+#        print("Found cached file {}".format(cached_name))
     except IOError:
 #        print("Couldn't load file {}".format(cached_name))
-        grid = None 
+        grid = None
     return grid
 
 def save_cached_grid(cached_name, grid):
 #    print("Caching file {}".format(cached_name))
-    np.save(cached_name, grid)
+    save_grid(cached_name, grid)
+    if cache_max_bytes > 0:
+        evict_cached(cache_max_bytes, keep=cached_name)
+
+def _touch(cached_name):
+    # Record use, for least recently used eviction
+    for f in grid_files(cached_name):
+        try:
+            os.utime(f)
+        except OSError:
+            pass
 
 def load_cacheable_grid(label, wfo, func, use_caching=True):
+    if not use_caching:
+        return func()
     cachename = gen_cached_name(label, wfo)
-    grid = None
-    if use_caching:
-        grid = load_cached_grid(cachename)
+    grid = load_cached_grid(cachename)
     if grid is None:
-        grid = func()
-        if use_caching:
-          save_cached_grid(cachename, grid)
-    return grid
\ No newline at end of file
+        # Only one process computes a missing entry; others wait then load it
+        with cache_lock(cachename):
+            grid = load_cached_grid(cachename)
+            if grid is None:
+                cache_counts['misses'] += 1
+                grid = func()
+                save_cached_grid(cachename, grid)
+                return grid
+        cache_counts['waits'] += 1
+    cache_counts['hits'] += 1
+    _touch(cachename)
+    return grid
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Inspect or manage the grid cache')
+    parser.add_argument('command', choices=['stats', 'list', 'evict', 'clear'])
+    parser.add_argument('--dir', default=cache_dir, help='cache directory')
+    parser.add_argument('--max-bytes', type=int, default=cache_max_bytes, help='size limit for evict')
+    args = parser.parse_args()
+    set_cache_dir(args.dir)
+    if args.command == 'stats':
+        print(json.dumps(cache_stats(), indent=1))
+    elif args.command == 'list':
+        for entry in cached_entries():
+            print('{:>12d} {} {} {}'.format(entry['bytes'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['last_used'])),
+                                            'packed' if entry['packed'] else 'dense ', entry['name']))
+    elif args.command == 'evict':
+        if args.max_bytes <= 0:
+            parser.error('evict needs a size limit, from --max-bytes or TOLIMAN_CACHE_MAX_BYTES')
+        evict_cached(args.max_bytes)
+    elif args.command == 'clear':
+        clear_all_cached()
@@ -1,5 +1,12 @@
 import numpy as np
-import proper
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+import json
+import os
+
+# Recommended gridsize and beam_ratio per prescription, used for gridsize='auto'
+# and written by convergence.py
+grid_config_file = os.environ.get('TOLIMAN_GRID_CONFIG', 'grid_config.json')
 
 def normalise_sampling(wavefronts, samplings, common_sampling, npsf):
     """Resample each wavefront to a common grid
@@ -31,7 +38,12 @@ def normalise_sampling(wavefronts, samplings, common_sampling, npsf):
     for i in range(n):
         wf = wavefronts[i] # np.abs(wavefronts[i])**2
         mag = samplings[i] / common_sampling
-        out[i,:,:] = proper.prop_magnify(wf, mag, npsf, CONSERVE = True)
+        if np.isclose(mag, 1., rtol=1e-9, atol=0.) and wf.shape[0] >= npsf:
+            # Already at the common sampling, so just crop about the centre
+            c = wf.shape[0]//2 - npsf//2
+            out[i,:,:] = wf[c:c+npsf, c:c+npsf]
+        else:
+            out[i,:,:] = proper.prop_magnify(wf, mag, npsf, CONSERVE = True)
     return out
 
 def combine_psfs(psfs, weights):
@@ -90,14 +102,15 @@ def fix_prop_pixellate(image_in, sampling_in, sampling_out, n_out = 0):
     """
     n_in = image_in.shape[0]
     
-    n_in_half = int(n_in/2)
+    # Centre pixel is at n_in//2 for any size, as for PROPER grids
+    n_in_half = n_in//2
     
     # Compute pixel transfer function (MTF)
     psize = 0.5 * (sampling_out / sampling_in)
     constant = psize * np.pi
     mag = sampling_in / sampling_out
     
-    arr = np.arange(n_in, dtype = np.float64) - n_in/2.
+    arr = np.arange(n_in, dtype = np.float64) - n_in_half
     # BJ
 #    x = np.roll(arr, -n_in/2, 0) / (n_in/2.)
     x = np.roll(arr, -n_in_half, 0) / (n_in/2.)
@@ -119,14 +132,185 @@ def fix_prop_pixellate(image_in, sampling_in, sampling_out, n_out = 0):
     
     # Image is integrated over pixels but has original sampling; now, resample
     # pixel sampling
-    if n_out != 0:
+    if n_out == 0:
         n_out = int(np.fix(n_in * mag))
         
     new = proper.prop_magnify(convolved_image, mag, n_out)
     
     return new
 
-def form_detector_image(prescription, sources, gridsize, detector_pitch, npixels, multi=True):
+# FFT backend for this process, passed on to worker processes through the
+# environment
+fft_environment = 'TOLIMAN_FFT'
+FFT_BACKENDS = ('numpy', 'fftw', 'intel')
+
+def select_fft(backend=None, mkl_dir=None):
+    """Select the PROPER FFT backend for this process and its workers
+
+    Unlike PROPER's prop_use_fftw and prop_use_ffti, which record the choice
+    in the home directory for every later run (including concurrent jobs),
+    this only sets PROPER's flags in this process, and TOLIMAN_FFT for
+    worker processes, which apply it when they call select_fft().
+
+    Parameters
+    ----------
+    backend : str
+        'numpy', 'fftw' or 'intel'. Default is TOLIMAN_FFT if set, otherwise
+        the current backend is kept.
+
+    mkl_dir : str
+        Directory of the Intel MKL library, checked for 'intel'
+
+    Returns
+    -------
+    previous : str
+        The backend selected before
+    """
+    if getattr(proper, 'use_ffti', False):
+        previous = 'intel'
+    elif getattr(proper, 'use_fftw', False):
+        previous = 'fftw'
+    else:
+        previous = 'numpy'
+    if backend is None:
+        backend = os.environ.get(fft_environment)
+        if backend is None:
+            return previous
+    if backend not in FFT_BACKENDS:
+        raise ValueError('Unknown FFT backend "{}"'.format(backend))
+    if backend == 'fftw':
+        import pyfftw
+    elif backend == 'intel':
+        import ctypes
+        ctypes.cdll.LoadLibrary(os.path.join(mkl_dir or '/opt/intel/mkl/lib/intel64', 'libmkl_rt.so'))
+    # As prop_use_fftw and prop_use_ffti set them
+    proper.use_fftw = backend in ('fftw', 'intel')
+    proper.use_ffti = backend == 'intel'
+    os.environ[fft_environment] = backend
+    return previous
+
+def fft_radices():
+    """Prime factors handled efficiently by the active PROPER FFT backend"""
+    if getattr(proper, 'use_fftw', False) or getattr(proper, 'use_ffti', False):
+        # FFTW and MKL have optimised codelets for small primes up to 7
+        return (2, 3, 5, 7)
+    # numpy's pocketfft
+    return (2, 3, 5)
+
+def smooth_sizes(minimum, maximum, radices):
+    """Even sizes in [minimum, maximum] with no prime factors outside radices"""
+    sizes = [1]
+    for p in radices:
+        extended = []
+        for s in sizes:
+            while s <= maximum:
+                extended.append(s)
+                s *= p
+        sizes = extended
+    return sorted(s for s in sizes if s >= minimum and s % 2 == 0)
+
+def fast_gridsize(minimum, benchmark=False, candidates=4):
+    """Choose an FFT-friendly gridsize at or above a minimum
+    
+    Grids need not be powers of two: sizes such as 2560, 3072 or 3200 are 
+    nearly as fast per pixel, and allow much finer control of cost.
+    
+    Parameters
+    ----------
+    minimum : int
+        Smallest acceptable gridsize
+        
+    benchmark : bool
+        Time 2D FFTs of the smallest few suitable sizes with the active 
+        backend, and return the fastest. Otherwise return the smallest.
+        
+    candidates : int
+        Number of sizes to time when benchmarking
+        
+    Returns
+    -------
+    gridsize : int
+        Even gridsize with only small prime factors
+    """
+    sizes = smooth_sizes(minimum, 2*minimum + 2, fft_radices())
+    if not benchmark:
+        return sizes[0]
+    import time
+    if getattr(proper, 'use_fftw', False):
+        fft = lambda a: proper.prop_fftw(a, directionFFTW = 'FFTW_FORWARD')
+    else:
+        fft = np.fft.fft2
+    best = None
+    for n in sizes[:candidates]:
+        a = np.ones((n, n), dtype = np.complex128)
+        fft(a) # first call may include planning
+        start = time.time()
+        fft(a)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[1]:
+            best = (n, elapsed)
+    return best[0]
+
+def auto_grid(prescription, sources):
+    """Apply the recommended gridsize and beam ratio for a prescription
+    
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription
+        
+    sources : list of dict
+        Sources as passed to form_detector_image
+        
+    Returns
+    -------
+    gridsize : int
+        Recommended gridsize
+        
+    sources : list of dict
+        Copies of the sources with the recommended beam_ratio in their settings
+    """
+    with open(grid_config_file) as f:
+        config = json.load(f)[prescription]
+    sources = [dict(source, settings=dict(source['settings'], beam_ratio=config['beam_ratio'])) for source in sources]
+    return config['gridsize'], sources
+
+def form_psf(prescription, sources, gridsize, detector_pitch, npixels, multi=True):
+    """Form the combined PSF of all sources at Nyquist sampling for the detector
+    
+    This is the broadband, multi-source image prior to integration over 
+    detector pixels, sampled at half the detector pitch.
+    
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+        
+    sources : list of dict
+        Sources, each with 'settings', 'wavelengths' and 'weights' entries
+        
+    gridsize : int or str
+        Size of the wavefront grid used for propagation, or 'auto' for the 
+        configuration recommended by a convergence study (see auto_grid)
+        
+    detector_pitch : float
+        Size of detector pixels in metres
+        
+    npixels : int
+        Size of the detector, in pixels
+        
+    multi : bool
+        Use prop_run_multi to propagate all wavelengths in parallel
+        
+    Returns
+    -------
+    out : numpy ndarray
+        Returns 2D image of dimension 2*npixels with sampling detector_pitch/2.
+    """
+    if gridsize == 'auto':
+        gridsize, sources = auto_grid(prescription, sources)
+    # In worker processes, apply the backend chosen by the parent
+    select_fft()
     source_psfs = []
     common_sampling = detector_pitch/2. # for Nyquist 
     npsf = npixels*2
@@ -138,7 +322,7 @@ def form_detector_image(prescription, sources, gridsize, detector_pitch, npixels
         if multi is True:
             (wavefronts, samplings) = proper.prop_run_multi(prescription, wavelengths, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
             # prop_run_multi returns complex arrays, even when PSFs are intensity, so make real with abs
-            psfs = normalise_sampling(np.abs(wavefronts), samplings, common_sampling, npsf)
+            wavefronts = np.abs(wavefronts)
         else:
             wavefronts = []
             samplings = []
@@ -146,10 +330,77 @@ def form_detector_image(prescription, sources, gridsize, detector_pitch, npixels
                 (wavefront, sampling) = proper.prop_run(prescription, wl, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
                 wavefronts.append(wavefront)
                 samplings.append(sampling)
-            psfs = normalise_sampling(wavefronts, samplings, common_sampling, npsf)
-            
-        source_psfs.append(combine_psfs(psfs, wl_weights))
+            wavefronts = np.stack(wavefronts)
+
+        if np.allclose(samplings, samplings[0], rtol=1e-9, atol=0.):
+            # All wavelengths share a sampling (e.g. using 'sampling_wavelength'),
+            # so combine first and resample once
+            psf = combine_psfs(wavefronts, wl_weights)
+            psf = normalise_sampling([psf], samplings[:1], common_sampling, npsf)[0]
+        else:
+            psf = combine_psfs(normalise_sampling(wavefronts, samplings, common_sampling, npsf), wl_weights)
+        source_psfs.append(psf)
 
-    psf_all = combine_psfs(np.stack(source_psfs), [1. for i in range(len(source_psfs))])
-    return fix_prop_pixellate(psf_all, common_sampling, detector_pitch)
+    return combine_psfs(np.stack(source_psfs), [1. for i in range(len(source_psfs))])
 
+def matched_beam_ratio(prescription, settings, wavelength, gridsize, target_sampling):
+    """Find the beam ratio giving a required focal plane sampling
+    
+    Focal plane sampling is proportional to beam ratio, so a single run at 
+    the current beam ratio determines it. Using the result as 'beam_ratio' 
+    along with 'sampling_wavelength' set to the same wavelength (in metres) 
+    gives the target sampling at every wavelength, so no resampling is 
+    needed at all.
+    
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+        
+    settings : dict
+        PASSVALUE settings for the prescription
+        
+    wavelength : float
+        Wavelength in microns
+        
+    gridsize : int
+        Size of the wavefront grid
+        
+    target_sampling : float
+        Required focal plane sampling in metres, e.g. detector_pitch/2
+        
+    Returns
+    -------
+    beam_ratio : float
+        Beam ratio giving target_sampling at this wavelength
+    """
+    settings = {k: v for k, v in settings.items() if k != 'sampling_wavelength'}
+    (wavefront, sampling) = proper.prop_run(prescription, wavelength, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+    return settings.get('beam_ratio', 0.2) * target_sampling / sampling
+
+def form_detector_image(prescription, sources, gridsize, detector_pitch, npixels, multi=True, cube=False, fields=False,
+                        cache=True, path=None):
+    """Form the detector image of all sources
+
+    Parameters
+    ----------
+    prescription, sources, gridsize, detector_pitch, npixels, multi :
+        As for form_psf
+
+    cube : bool
+        Return a psf_cube.PSFCube of per-wavelength images, propagated when
+        first needed and cached on disk, instead of the combined image
+
+    fields, cache, path :
+        With cube, as for psf_cube.PSFCube
+
+    Returns
+    -------
+    out : numpy ndarray or psf_cube.PSFCube
+        2D image of dimension npixels, or the cube
+    """
+    if cube:
+        from psf_cube import PSFCube
+        return PSFCube(prescription, sources, gridsize, detector_pitch, npixels, multi=multi, fields=fields, cache=cache, path=path)
+    psf_all = form_psf(prescription, sources, gridsize, detector_pitch, npixels, multi=multi)
+    return fix_prop_pixellate(psf_all, detector_pitch/2., detector_pitch)
@@ -0,0 +1,218 @@
+"""Per-wavelength detector images, for reweighting without propagation
+
+form_detector_image(..., cube=True) returns a PSFCube instead of an image.
+Each plane of the cube is the detector image of one source at one
+wavelength with unit weight, propagated only when first needed and kept in
+a memory-mapped store in the PROPER cache directory, so any spectral
+weighting is then applied as a single tensor contraction:
+
+    cube = form_detector_image('prescription_rc_quad', sources, 2048, 11e-6, 512, cube=True)
+    image = cube.image()                    # the sources' own weights
+    image = cube.image(cube.plane_weights([star_a, star_b]))
+"""
+import json
+import os
+import numpy as np
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+from proper_tools import normalise_sampling, fix_prop_pixellate, auto_grid
+from job_service import request_hash
+import proper_cache
+
+CUBE_META = 'cube.json'
+CUBE_IMAGES = 'images.npy'
+CUBE_DONE = 'done.npy'
+CUBE_FIELDS = 'fields.npy'
+CUBE_SAMPLINGS = 'samplings.npy'
+
+def cube_key(prescription, sources, gridsize, detector_pitch, npixels, fields=False):
+    """Hash identifying a cube by content, as job_service.request_hash
+
+    Source weights are excluded, as they are applied afterwards. Raises
+    TypeError if a setting cannot be identified by content.
+    """
+    sources = [dict({k: v for k, v in source.items() if k != 'weights'},
+                    wavelengths=[float(wl) for wl in source['wavelengths']]) for source in sources]
+    return request_hash({'prescription': prescription, 'sources': sources, 'gridsize': gridsize,
+                         'detector_pitch': detector_pitch, 'npixels': npixels, 'fields': fields})
+
+def _open_array(directory, name, dtype, shape):
+    filename = os.path.join(directory, name)
+    if not os.path.exists(filename):
+        # A new file is sparse and reads as zeros, so planes take space on
+        # disk only once computed
+        tmp = '{}.{}.tmp'.format(filename, os.getpid())
+        arr = np.lib.format.open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+        del arr
+        os.replace(tmp, filename)
+    return np.load(filename, mmap_mode='r+')
+
+class PSFCube:
+    """Lazily propagated detector images of each source at each wavelength
+
+    Parameters
+    ----------
+    prescription, sources, gridsize, detector_pitch, npixels, multi :
+        As for form_detector_image
+
+    fields : bool
+        Also keep the complex focal plane field of each plane, at the
+        propagation grid and sampling. The prescription must support 'noabs'.
+
+    cache : bool
+        Keep planes in a store on disk, shared by every cube with the same
+        parameters; otherwise they are kept in memory. Cubes whose settings
+        cannot be identified by content (see cube_key), such as lambdas,
+        are always kept in memory.
+
+    path : str
+        Directory of the store. Default is a subdirectory of the PROPER
+        cache directory (see proper_cache.set_cache_dir) named by cube_key.
+
+    Attributes
+    ----------
+    planes : list of tuple
+        (source index, wavelength in microns) of each plane
+
+    weights : numpy ndarray
+        Weight of each plane given by the sources
+    """
+    def __init__(self, prescription, sources, gridsize, detector_pitch, npixels, multi=True,
+                 fields=False, cache=True, path=None):
+        if gridsize == 'auto':
+            gridsize, sources = auto_grid(prescription, sources)
+        self.prescription = prescription
+        self.sources = sources
+        self.gridsize = gridsize
+        self.detector_pitch = detector_pitch
+        self.npixels = npixels
+        self.multi = multi
+        self.planes = [(i, wl) for i, source in enumerate(sources) for wl in source['wavelengths']]
+        self.weights = np.concatenate([np.asarray(source['weights'], dtype = np.float64) for source in sources])
+        nplanes = len(self.planes)
+        image_shape = (nplanes, npixels, npixels)
+        field_shape = (nplanes, gridsize, gridsize)
+        if cache:
+            try:
+                key = cube_key(prescription, sources, gridsize, detector_pitch, npixels, fields)
+            except TypeError as e:
+                print('Not caching PSF cube: {}'.format(e))
+                cache = False
+        if not cache:
+            self.path = None
+            self.images = np.zeros(image_shape, dtype = np.float64)
+            self.done = np.zeros(nplanes, dtype = bool)
+            self.fields = np.zeros(field_shape, dtype = np.complex128) if fields else None
+            self.samplings = np.zeros(nplanes, dtype = np.float64)
+            return
+        self.path = path or os.path.join(proper_cache.cache_dir, 'cube_' + key)
+        os.makedirs(self.path, exist_ok=True)
+        meta = os.path.join(self.path, CUBE_META)
+        if not os.path.exists(meta):
+            with open(meta, 'w') as f:
+                json.dump({'key': key, 'prescription': prescription, 'gridsize': gridsize,
+                           'detector_pitch': detector_pitch, 'npixels': npixels,
+                           'planes': [[i, float(wl)] for i, wl in self.planes]}, f, indent=1)
+        self.images = _open_array(self.path, CUBE_IMAGES, np.float64, image_shape)
+        self.done = _open_array(self.path, CUBE_DONE, bool, (nplanes,))
+        self.fields = _open_array(self.path, CUBE_FIELDS, np.complex128, field_shape) if fields else None
+        self.samplings = _open_array(self.path, CUBE_SAMPLINGS, np.float64, (nplanes,))
+
+    def __len__(self):
+        return len(self.planes)
+
+    def compute(self, planes=None):
+        """Propagate planes not yet computed
+
+        Parameters
+        ----------
+        planes : list of int
+            Indices of the planes needed. Default is all.
+        """
+        if planes is None:
+            planes = range(len(self.planes))
+        missing = [p for p in planes if not self.done[p]]
+        common_sampling = self.detector_pitch/2.
+        for i, source in enumerate(self.sources):
+            todo = [p for p in missing if self.planes[p][0] == i]
+            if len(todo) == 0:
+                continue
+            wavelengths = [self.planes[p][1] for p in todo]
+            settings = source['settings']
+            if self.fields is not None:
+                settings = dict(settings, noabs=True)
+            if self.multi is True:
+                (wavefronts, samplings) = proper.prop_run_multi(self.prescription, wavelengths, gridsize = self.gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+            else:
+                wavefronts = []
+                samplings = []
+                for wl in wavelengths:
+                    (wavefront, sampling) = proper.prop_run(self.prescription, wl, gridsize = self.gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+                    wavefronts.append(wavefront)
+                    samplings.append(sampling)
+            for p, wavefront, sampling in zip(todo, wavefronts, samplings):
+                if self.fields is not None:
+                    self.fields[p] = wavefront
+                    psf = np.abs(wavefront)**2
+                else:
+                    # prop_run_multi returns complex arrays, even when PSFs are intensity
+                    psf = np.abs(wavefront)
+                psf = normalise_sampling([psf], [sampling], common_sampling, 2*self.npixels)[0]
+                self.images[p] = fix_prop_pixellate(psf, common_sampling, self.detector_pitch)
+                self.samplings[p] = sampling
+                self.done[p] = True
+        if self.path is not None:
+            for arr in (self.images, self.fields, self.samplings, self.done):
+                if arr is not None:
+                    arr.flush()
+
+    def plane_weights(self, weights):
+        """Weight of each plane from weights for each source
+
+        Parameters
+        ----------
+        weights : list
+            For each source, either an array of weights of its wavelengths
+            or a function of wavelength (microns), e.g. a spectrum
+            interpolated with np.interp
+
+        Returns
+        -------
+        out : numpy ndarray
+            Weights for image
+
+        Raises
+        ------
+        ValueError
+            If weights are not given for every source
+        """
+        if len(weights) != len(self.sources):
+            raise ValueError('Expected weights for {} sources, got {}'.format(len(self.sources), len(weights)))
+        out = np.zeros(len(self.planes), dtype = np.float64)
+        for i, w in enumerate(weights):
+            index = [p for p, (source, wl) in enumerate(self.planes) if source == i]
+            wls = np.array([self.planes[p][1] for p in index])
+            out[index] = w(wls) if callable(w) else w
+        return out
+
+    def image(self, weights=None):
+        """Detector image for a spectral weighting of the planes
+
+        Only planes with non-zero weight are propagated, if not already.
+
+        Parameters
+        ----------
+        weights : numpy ndarray
+            Weight of each plane (see plane_weights), or an array of shape
+            (n, nplanes) for n weightings at once. Default is the sources'
+            own weights, giving the image of form_detector_image.
+
+        Returns
+        -------
+        image : numpy ndarray
+            2D detector image, or a stack of n images
+        """
+        weights = self.weights if weights is None else np.asarray(weights, dtype = np.float64)
+        used = np.flatnonzero(np.any(np.atleast_2d(weights) != 0., axis=0))
+        self.compute(used)
+        return np.tensordot(weights[..., used], self.images[used], axes=([weights.ndim - 1], [0]))
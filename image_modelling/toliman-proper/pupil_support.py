@@ -0,0 +1,134 @@
+import numpy as np
+from collections import OrderedDict
+from proper_cache import gen_cached_name, load_cacheable_grid
+
+# Supports of cached grids already loaded by this process, most recent last
+max_supports = 64
+_supports = OrderedDict()
+
+def grid_support(grid, outside=1., centred=False):
+    """Find the bounding box of a grid's pixels that differ from a background
+
+    Parameters
+    ----------
+    grid : numpy ndarray
+        Square 2D grid, in PROPER wavefront array order (centre at [0,0],
+        as from prop_shift_center) unless centred is set
+
+    outside : float
+        Background value, 1 for obscurations and phase factors, 0 for
+        apertures and OPD maps
+
+    centred : bool
+        The grid has its centre at [n//2, n//2], e.g. from gen_opdmap
+
+    Returns
+    -------
+    support : dict
+        'rows' and 'cols' indices of the box in wavefront array order, the
+        grid 'values' within the box, and the 'outside' value
+    """
+    n = grid.shape[0]
+    differs = grid != outside
+    rows = np.any(differs, axis=1)
+    cols = np.any(differs, axis=0)
+    if not centred:
+        # Wavefront arrays hold centred pixel c at (c + n//2) % n
+        rows = np.roll(rows, -(n//2))
+        cols = np.roll(cols, -(n//2))
+    r = np.flatnonzero(rows)
+    c = np.flatnonzero(cols)
+    if r.size == 0:
+        r = c = np.zeros(0, dtype = int)
+    else:
+        r = np.arange(r[0], r[-1] + 1)
+        c = np.arange(c[0], c[-1] + 1)
+    support = {'rows': (r + n//2) % n, 'cols': (c + n//2) % n, 'outside': outside}
+    if centred:
+        support['values'] = grid[np.ix_(r, c)]
+    else:
+        support['values'] = grid[np.ix_(support['rows'], support['cols'])]
+    return support
+
+def apply_support(wf, support):
+    """Multiply the wavefront by a grid, touching only its support
+
+    Outside the support box the grid equals support['outside']; if that is 1
+    the wavefront is left alone there, and if 0 it is zeroed.
+
+    Parameters
+    ----------
+    wf : obj
+        WaveFront class object
+
+    support : dict
+        From grid_support
+
+    Returns
+    -------
+        None
+        Modifies wavefront array in wf object.
+    """
+    ix = np.ix_(support['rows'], support['cols'])
+    wf.wfarr[ix] *= support['values']
+    if support['outside'] == 0.:
+        n = wf.wfarr.shape[0]
+        outside = np.ones(n, dtype = bool)
+        outside[support['rows']] = False
+        wf.wfarr[outside,:] = 0.
+        outside[:] = True
+        outside[support['cols']] = False
+        wf.wfarr[:,outside] = 0.
+    elif support['outside'] != 1.:
+        raise ValueError('Support background must be 0 or 1')
+
+def apply_opd_support(wf, support):
+    """Add an OPD map to the wavefront, touching only its support
+
+    Parameters
+    ----------
+    wf : obj
+        WaveFront class object
+
+    support : dict
+        From grid_support of an OPD map in metres, with outside 0
+
+    Returns
+    -------
+        None
+        Modifies wavefront array in wf object.
+    """
+    ix = np.ix_(support['rows'], support['cols'])
+    wf.wfarr[ix] *= np.exp(2j*np.pi/wf.lamda * support['values'])
+
+def load_cacheable_support(label, wfo, func, use_caching=True, outside=1., centred=False):
+    """Load a cacheable grid as its support
+
+    As load_cacheable_grid, but returns the support of the grid. With caching
+    on, supports are also kept in memory, so later runs in the same process
+    neither reload nor rescan the grid.
+
+    Parameters
+    ----------
+    label, wfo, func, use_caching :
+        As for load_cacheable_grid
+
+    outside, centred :
+        As for grid_support
+
+    Returns
+    -------
+    support : dict
+        From grid_support
+    """
+    if not use_caching:
+        return grid_support(func(), outside, centred)
+    key = gen_cached_name(label, wfo)
+    if key in _supports:
+        _supports.move_to_end(key)
+        return _supports[key]
+    support = grid_support(load_cacheable_grid(label, wfo, func, use_caching), outside, centred)
+    _supports[key] = support
+    if len(_supports) > max_supports:
+        _supports.popitem(last=False)
+    return support
@@ -0,0 +1,260 @@
+import numpy as np
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# Calibrated model coefficients, written by calibrate() via save_model
+resource_model_file = os.environ.get('TOLIMAN_RESOURCE_MODEL', 'resource_model.json')
+
+# Coefficients for the features of job_features, used until calibrated.
+# memory: bytes for the interpreter and modules, multiples of each wavefront
+# held concurrently (the array plus FFT temporaries), of the stack returned by
+# prop_run_multi, and of grids built when not cached.
+# runtime: seconds of overhead, per unit of FFT work, and per pixel of grids
+# built when not cached.
+DEFAULT_MODEL = {'memory': [3e8, 4., 1., 6.],
+                 'runtime': [1., 5e-8, 3e-7]}
+
+def job_features(sources, gridsize, multi=True, complex_bytes=16, cores=None):
+    """Features of a form_detector_image job that determine its cost
+
+    Parameters
+    ----------
+    sources : list of dict
+        Sources as passed to form_detector_image
+
+    gridsize : int
+        Size of the wavefront grid
+
+    multi : bool
+        Wavelengths are propagated in parallel with prop_run_multi
+
+    complex_bytes : int
+        Bytes per wavefront element, 16 for double and 8 for single precision
+
+    cores : int
+        Cores available to prop_run_multi. Default is the number of CPUs.
+
+    Returns
+    -------
+    features : dict
+        'memory' and 'runtime' feature vectors, and the 'cores' the job
+        occupies
+    """
+    n2 = float(gridsize)**2
+    nsources = len(sources)
+    nwl = max(len(source['wavelengths']) for source in sources)
+    cached = all(source['settings'].get('use_caching', False) for source in sources)
+    concurrent = min(nwl, cores or os.cpu_count()) if multi else 1
+    return {'memory': [1.,
+                       concurrent * n2 * complex_bytes,
+                       nwl * n2 * 16. if multi else 0.,
+                       0. if cached else n2 * 8.],
+            'runtime': [1.,
+                        nsources * nwl * n2 * np.log2(gridsize) / concurrent,
+                        0. if cached else nsources * nwl * n2 / concurrent],
+            'cores': concurrent}
+
+def load_model(filename=None):
+    """Calibrated model coefficients, or DEFAULT_MODEL if not calibrated"""
+    filename = filename or resource_model_file
+    if not os.path.exists(filename):
+        return DEFAULT_MODEL
+    with open(filename) as f:
+        return json.load(f)
+
+def save_model(model, filename=None):
+    with open(filename or resource_model_file, 'w') as f:
+        json.dump(model, f, indent=1)
+
+def predict(sources, gridsize, multi=True, complex_bytes=16, cores=None, model=None):
+    """Predict the peak memory and runtime of a form_detector_image job
+
+    Parameters
+    ----------
+    sources, gridsize, multi, complex_bytes, cores :
+        As for job_features
+
+    model : dict
+        Model coefficients. Default is from load_model.
+
+    Returns
+    -------
+    prediction : dict
+        Peak 'memory' in bytes, 'runtime' in seconds, and 'cores' occupied
+    """
+    model = model or load_model()
+    features = job_features(sources, gridsize, multi, complex_bytes, cores)
+    return {'memory': float(np.dot(model['memory'], features['memory'])),
+            'runtime': float(np.dot(model['runtime'], features['runtime'])),
+            'cores': features['cores']}
+
+def _measured_run(prescription, sources, gridsize, detector_pitch, npixels, multi):
+    import resource
+    from proper_tools import form_detector_image
+    start = time.time()
+    form_detector_image(prescription, sources, gridsize, detector_pitch, npixels, multi=multi)
+    runtime = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    return (runtime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+def measure(prescription, sources, gridsize, detector_pitch, npixels, multi=True):
+    """Measure the peak memory and runtime of a form_detector_image job
+
+    The job is run in a fresh process, so its peak resident size is its own.
+    prop_run_multi's worker processes run concurrently, so their largest
+    peak counts once for each concurrently propagated wavelength.
+
+    Parameters
+    ----------
+    prescription, sources, gridsize, detector_pitch, npixels, multi :
+        As for form_detector_image
+
+    Returns
+    -------
+    measurement : dict
+        Measured 'memory' (bytes) and 'runtime' (seconds), and the job's
+        'features' from job_features
+    """
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        runtime, rss, rss_children = executor.submit(_measured_run, prescription, sources, gridsize,
+                                                     detector_pitch, npixels, multi).result()
+    features = job_features(sources, gridsize, multi)
+    return {'memory': rss + features['cores'] * rss_children if multi else rss,
+            'runtime': runtime,
+            'features': features}
+
+def calibrate(measurements):
+    """Fit model coefficients to measurements
+
+    Parameters
+    ----------
+    measurements : list of dict
+        From measure, covering a range of gridsizes and wavelength counts,
+        with and without multi and caching
+
+    Returns
+    -------
+    model : dict
+        Coefficients for predict, fitted by least squares and constrained
+        to be non-negative
+    """
+    model = {}
+    for key in ('memory', 'runtime'):
+        a = np.array([m['features'][key] for m in measurements])
+        b = np.array([m[key] for m in measurements])
+        # Scale columns, as features span many orders of magnitude
+        scale = np.max(np.abs(a), axis=0)
+        scale[scale == 0] = 1.
+        coeffs = np.linalg.lstsq(a / scale, b, rcond=None)[0] / scale
+        # Unconstrained features (e.g. never uncached) keep their defaults
+        unused = np.all(a == 0, axis=0)
+        coeffs[unused] = np.array(DEFAULT_MODEL[key])[unused]
+        model[key] = np.clip(coeffs, 0., None).tolist()
+    return model
+
+def available_memory():
+    """Memory available for new jobs on this node, in bytes"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def max_concurrent(prediction, memory=None, cores=None, safety=0.8):
+    """How many identical jobs fit on this node at once
+
+    Parameters
+    ----------
+    prediction : dict
+        From predict
+
+    memory : int
+        Memory budget in bytes. Default is the memory available now.
+
+    cores : int
+        Core budget. Default is the number of CPUs.
+
+    safety : float
+        Fraction of the memory budget to use, allowing for model error
+
+    Returns
+    -------
+    n : int
+        Number of jobs to run concurrently, at least 1
+    """
+    memory = safety * (memory or available_memory())
+    cores = cores or os.cpu_count()
+    return max(1, min(cores // max(1, prediction['cores']), int(memory // prediction['memory'])))
+
+def run_scheduled(func, jobs, predictions, memory=None, cores=None, safety=0.8, callback=None):
+    """Run jobs in parallel, packed onto the node's memory and cores
+
+    Jobs are started largest first while their predicted memory and cores
+    fit within the budget alongside those already running; as each job
+    finishes, the largest waiting jobs that now fit are started.
+
+    Parameters
+    ----------
+    func : function
+        Function to run in worker processes
+
+    jobs : list of tuple
+        Arguments for func, one tuple per job
+
+    predictions : list of dict
+        Predicted resources of each job, from predict
+
+    memory, cores, safety :
+        As for max_concurrent
+
+    callback : function
+        Called as callback(i, result) as each job i finishes, e.g. to store
+        results as they arrive. Results are then not kept.
+
+    Returns
+    -------
+    results : list
+        Result of each job, in the order of jobs, or None with callback
+
+    Raises
+    ------
+    ValueError
+        If a job alone would exceed the memory budget
+    """
+    memory = safety * (memory or available_memory())
+    cores = cores or os.cpu_count()
+    for i, prediction in enumerate(predictions):
+        if prediction['memory'] > memory:
+            raise ValueError('Job {} needs {:.3g} bytes, more than the budget of {:.3g}'.format(i, prediction['memory'], memory))
+    waiting = sorted(range(len(jobs)), key=lambda i: -predictions[i]['memory'])
+    results = [None] * len(jobs)
+    running = {}
+    used_memory = 0.
+    used_cores = 0
+    with ProcessPoolExecutor(max_workers=cores) as executor:
+        while waiting or running:
+            for i in list(waiting):
+                prediction = predictions[i]
+                # A job needing more cores than there are still runs, alone
+                fits_cores = used_cores + prediction['cores'] <= cores or len(running) == 0
+                if used_memory + prediction['memory'] <= memory and fits_cores:
+                    running[executor.submit(func, *jobs[i])] = i
+                    used_memory += prediction['memory']
+                    used_cores += prediction['cores']
+                    waiting.remove(i)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                used_memory -= predictions[i]['memory']
+                used_cores -= predictions[i]['cores']
+                if callback is None:
+                    results[i] = future.result()
+                else:
+                    callback(i, future.result())
+    return results
@@ -0,0 +1,66 @@
+# Install the toliman-proper modules, e.g. with
+#   pip install -e image_modelling/toliman-proper
+# so that scripts and notebooks no longer need to extend sys.path.
+# PROPER itself is not on PyPI and must be installed separately (see
+# pendragon_install.md).
+from setuptools import setup
+
+# Modules stay top-level, as PROPER imports prescriptions by name
+modules = [
+           'build_phase_map',
+           'build_prop_circular_aperture',
+           'build_prop_circular_obscuration',
+           'build_prop_rectangular_obscuration',
+           'cache_storage',
+           'chromatic',
+           'convergence',
+           'coordinates',
+           'detector',
+           'gen_opdmap',
+           'gen_phasemap',
+           'job_service',
+           'import_budget',
+           'jitter',
+           'lazy_import',
+           'prescription_quad',
+           'prescription_quad_tiltafter',
+           'prescription_rc_conic',
+           'prescription_rc_quad',
+           'prop_conic',
+           'prop_tilt',
+           'proper_cache',
+           'proper_tools',
+           'psf_cube',
+           'pupil_support',
+           'resource_model',
+           'spectral',
+           'spirals',
+           'stack_analysis',
+           'sweep',
+           'telescope',
+           'toliman_prescription_simple',
+           'toliman_sim',
+           'warmup',
+           'work_queue',
+           'zemax_compare',
+           'zernike',
+           ]
+
+setup(
+      name='toliman',
+      version='0.1',
+      description='TOLIMAN telescope image modelling with PROPER',
+      py_modules=modules,
+      python_requires='>=3.6',
+      install_requires=['numpy'],
+      # Imported lazily, only when used
+      extras_require={
+                      'fftw': ['pyfftw'],
+                      'plot': ['matplotlib'],
+                      'poppy': ['poppy'],
+                      'config': ['pyyaml', 'tomli; python_version < "3.11"'],
+                      },
+      entry_points={
+                    'console_scripts': ['toliman-sim = toliman_sim:main'],
+                    },
+      )
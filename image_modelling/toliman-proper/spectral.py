@@ -0,0 +1,221 @@
+import numpy as np
+import codecs
+from proper_tools import form_detector_image
+
+def load_spectrum(filename):
+    """Load a two column spectrum or filter curve from a text file
+
+    Handles plain text and Zemax exports (UTF-16, with a free-form header).
+    Lines whose first two fields are not numbers are skipped, and fields may
+    be separated by whitespace or commas.
+
+    Parameters
+    ----------
+    filename : str
+        File of wavelength (microns) and value pairs
+
+    Returns
+    -------
+    wavelengths, values : numpy ndarray
+        Columns of the file, sorted by wavelength
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    if raw.startswith(codecs.BOM_UTF16_LE) or raw.startswith(codecs.BOM_UTF16_BE):
+        text = raw.decode('utf-16')
+    else:
+        text = raw.decode('utf-8', errors='replace')
+    rows = []
+    for line in text.splitlines():
+        fields = line.replace(',', ' ').split()
+        try:
+            rows.append((float(fields[0]), float(fields[1])))
+        except (IndexError, ValueError):
+            continue
+    rows = np.array(sorted(rows), dtype = np.float64)
+    return rows[:,0], rows[:,1]
+
+def spectral_weights(filter_wl, filter_tr, star_wl=None, star_flux=None, photon=True):
+    """Combine a filter curve and stellar spectrum into a dense weighting
+
+    Parameters
+    ----------
+    filter_wl, filter_tr : numpy ndarray or str
+        Filter wavelengths (microns) and transmission, or a filename for
+        load_spectrum in filter_wl (filter_tr is then ignored)
+
+    star_wl, star_flux : numpy ndarray or str
+        Stellar spectrum wavelengths (microns) and flux per unit wavelength,
+        or a filename in star_wl. Default is a flat spectrum.
+
+    photon : bool
+        Weight by photon count (flux * wavelength) rather than energy
+
+    Returns
+    -------
+    wavelengths : numpy ndarray
+        Dense wavelength grid in microns, that of the filter curve
+
+    weights : numpy ndarray
+        Weight of each dense wavelength, normalised to sum to one
+    """
+    if isinstance(filter_wl, str):
+        filter_wl, filter_tr = load_spectrum(filter_wl)
+    if isinstance(star_wl, str):
+        star_wl, star_flux = load_spectrum(star_wl)
+    wl = np.asarray(filter_wl, dtype = np.float64)
+    w = np.asarray(filter_tr, dtype = np.float64) * np.gradient(wl)
+    if star_wl is not None:
+        w *= np.interp(wl, star_wl, star_flux, left=0., right=0.)
+    if photon:
+        w *= wl
+    w = np.clip(w, 0., None)
+    return wl, w / np.sum(w)
+
+def gauss_quadrature(wavelengths, weights, n):
+    """Gaussian quadrature wavelengths and weights for a spectral weighting
+
+    The n wavelengths and weights integrate exactly any polynomial in
+    wavelength of degree up to 2n-1 against the dense weighting, which is
+    the fewest wavelengths possible for that accuracy. They are found by the
+    Golub-Welsch method, building the Jacobi matrix by Lanczos iteration on
+    the discrete weighting.
+
+    Parameters
+    ----------
+    wavelengths : numpy ndarray
+        Dense wavelength grid
+
+    weights : numpy ndarray
+        Non-negative weight of each dense wavelength
+
+    n : int
+        Number of quadrature wavelengths
+
+    Returns
+    -------
+    nodes : numpy ndarray
+        Quadrature wavelengths, within the range of the dense grid
+
+    node_weights : numpy ndarray
+        Quadrature weights, summing to the total of weights
+    """
+    x = np.asarray(wavelengths, dtype = np.float64)
+    w = np.asarray(weights, dtype = np.float64)
+    total = np.sum(w)
+    n = min(n, np.count_nonzero(w))
+    # Map to [-1, 1] for conditioning
+    mid = 0.5 * (x.max() + x.min())
+    half = 0.5 * (x.max() - x.min()) or 1.
+    t = (x - mid) / half
+    q = np.zeros((n, x.size), dtype = np.float64)
+    alpha = np.zeros(n)
+    beta = np.zeros(n)
+    q[0] = np.sqrt(w / total)
+    for k in range(n):
+        v = t * q[k]
+        alpha[k] = np.dot(q[k], v)
+        # Full reorthogonalisation keeps the Lanczos vectors orthogonal
+        v -= np.dot(q[:k+1].T, np.dot(q[:k+1], v))
+        if k < n - 1:
+            beta[k] = np.linalg.norm(v)
+            q[k+1] = v / beta[k]
+    jacobi = np.diag(alpha) + np.diag(beta[:n-1], 1) + np.diag(beta[:n-1], -1)
+    nodes, vectors = np.linalg.eigh(jacobi)
+    return mid + half * nodes, total * vectors[0]**2
+
+def monochromatic_image_func(prescription, sources, gridsize, detector_pitch, npixels):
+    """Make a function giving the detector image at a single wavelength
+
+    Parameters
+    ----------
+    prescription, sources, gridsize, detector_pitch, npixels :
+        As for form_detector_image. Source wavelengths and weights are
+        replaced.
+
+    Returns
+    -------
+    image_func : function
+        Function of wavelength (microns) returning the detector image of all
+        sources with unit weight
+    """
+    def image_func(wavelength):
+        mono = [dict(source, wavelengths=[wavelength], weights=[1.]) for source in sources]
+        return form_detector_image(prescription, mono, gridsize, detector_pitch, npixels, multi=False)
+    return image_func
+
+def quadrature_image(image_func, nodes, node_weights, images=None):
+    """Broadband image from a weighted sum of monochromatic images
+
+    Parameters
+    ----------
+    image_func : function
+        Function of wavelength returning a monochromatic image
+
+    nodes, node_weights : numpy ndarray
+        Wavelengths and weights to sum over
+
+    images : dict
+        Optional store of images already computed, keyed by wavelength; new
+        images are added to it.
+
+    Returns
+    -------
+    image : numpy ndarray
+        Weighted sum of images
+    """
+    if images is None:
+        images = {}
+    out = 0.
+    for wl, weight in zip(nodes, node_weights):
+        if wl not in images:
+            images[wl] = image_func(wl)
+        out = out + weight * images[wl]
+    return out
+
+def optimal_quadrature(wavelengths, weights, image_func, tol=1e-4, n_max=16, reference='dense'):
+    """Find the fewest wavelengths reproducing a broadband image to a tolerance
+
+    Gaussian quadratures of increasing size are compared with a reference
+    broadband image until the relative RMS difference is within tol.
+
+    Parameters
+    ----------
+    wavelengths, weights : numpy ndarray
+        Dense spectral weighting, e.g. from spectral_weights
+
+    image_func : function
+        Function of wavelength returning a monochromatic image, e.g. from
+        monochromatic_image_func
+
+    tol : float
+        Required relative RMS difference from the reference image
+
+    n_max : int
+        Largest number of wavelengths to try
+
+    reference : int or str
+        'dense' (the default) to form the reference from every dense
+        wavelength, with one propagation per wavelength, or the size of a
+        Gaussian quadrature to use as a cheaper reference, e.g. 2*n_max
+
+    Returns
+    -------
+    nodes, node_weights : numpy ndarray
+        Quadrature wavelengths (microns) and weights
+
+    error : float
+        Relative RMS difference of the quadrature image from the reference
+    """
+    if reference == 'dense':
+        ref = quadrature_image(image_func, wavelengths, weights)
+    else:
+        ref = quadrature_image(image_func, *gauss_quadrature(wavelengths, weights, reference))
+    ref_norm = np.sqrt(np.sum(ref**2))
+    for n in range(1, n_max + 1):
+        nodes, node_weights = gauss_quadrature(wavelengths, weights, n)
+        image = quadrature_image(image_func, nodes, node_weights)
+        error = np.sqrt(np.sum((image - ref)**2)) / ref_norm
+        if error <= tol:
+            break
+    return nodes, node_weights, error
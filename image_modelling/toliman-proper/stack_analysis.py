@@ -0,0 +1,206 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+def stack_viewport(images, size=128):
+    """Central size by size region of each image in a stack (a view)"""
+    lo = images.shape[-1]//2 - size//2
+    return images[..., lo:lo+size, lo:lo+size]
+
+def stack_centroids(images):
+    """Flux-weighted centroids of a stack of images
+
+    Parameters
+    ----------
+    images : numpy ndarray
+        Stack of 2D images
+
+    Returns
+    -------
+    out : numpy ndarray
+        Array of shape (n, 2), the (row, column) centroid of each image in
+        pixels, as for jitter.centroid
+    """
+    images = np.asarray(images, dtype = np.float64)
+    total = np.sum(images, axis=(1, 2))
+    rows = np.sum(images, axis=2)
+    cols = np.sum(images, axis=1)
+    return np.stack([np.dot(rows, np.arange(rows.shape[1])) / total,
+                     np.dot(cols, np.arange(cols.shape[1])) / total], axis=1)
+
+def window_centroids(images, positions, size=32):
+    """Centroids within windows about given positions, e.g. each star of a binary
+
+    Parameters
+    ----------
+    images : numpy ndarray
+        Stack of 2D images
+
+    positions : list of tuple
+        Approximate (row, column) pixel position of each star
+
+    size : int
+        Window size in pixels
+
+    Returns
+    -------
+    out : numpy ndarray
+        Array of shape (n, len(positions), 2) of centroids in image pixels
+    """
+    out = np.empty((images.shape[0], len(positions), 2), dtype = np.float64)
+    for k, (row, col) in enumerate(positions):
+        r0 = max(0, int(round(row)) - size//2)
+        c0 = max(0, int(round(col)) - size//2)
+        out[:,k,:] = stack_centroids(images[:, r0:r0+size, c0:c0+size]) + [r0, c0]
+    return out
+
+def radial_bins(n, centre=None, nbins=None):
+    """Integer radius of each pixel, for radial_profiles
+
+    Parameters
+    ----------
+    n : int
+        Image size
+
+    centre : tuple
+        (row, column) centre. Default is [n//2, n//2].
+
+    nbins : int
+        Number of 1-pixel-wide annuli; pixels beyond are excluded. Default
+        reaches the edge of the image.
+
+    Returns
+    -------
+    bins : numpy ndarray
+        Annulus index of each pixel, or -1 for excluded pixels
+    """
+    if centre is None:
+        centre = (n//2, n//2)
+    rows = np.arange(n) - centre[0]
+    cols = np.arange(n) - centre[1]
+    r = np.sqrt(rows[:,np.newaxis]**2 + cols[np.newaxis,:]**2)
+    bins = np.floor(r + 0.5).astype(np.int64)
+    if nbins is None:
+        nbins = n//2
+    bins[bins >= nbins] = -1
+    return bins
+
+def radial_profiles(images, bins):
+    """Azimuthally averaged profile of each image in a stack
+
+    Pixels are sorted by annulus once, so each chunk is reduced with a single
+    np.add.reduceat over the whole stack.
+
+    Parameters
+    ----------
+    images : numpy ndarray
+        Stack of 2D images
+
+    bins : numpy ndarray
+        Annulus of each pixel, from radial_bins
+
+    Returns
+    -------
+    out : numpy ndarray
+        Array of shape (n, nbins) of mean intensity in each annulus
+    """
+    flat = bins.ravel()
+    order = np.argsort(flat, kind='stable')
+    order = order[flat[order] >= 0]
+    counts = np.bincount(flat[order])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    pixels = np.asarray(images, dtype = np.float64).reshape(images.shape[0], -1)[:, order]
+    return np.add.reduceat(pixels, starts, axis=1) / counts
+
+def _analyse_chunk(images, reference, size, positions, window, bins):
+    out = {}
+    vp = np.asarray(stack_viewport(images, size), dtype = np.float64)
+    out['centroid'] = stack_centroids(vp) + (images.shape[-1]//2 - size//2)
+    if reference is not None:
+        sum_sq = np.sum((vp - stack_viewport(reference, size))**2, axis=(1, 2))
+        out['sum_sq'] = sum_sq
+        out['rms'] = np.sqrt(sum_sq / size**2)
+    if positions is not None:
+        stars = window_centroids(images, positions, window)
+        out['star_centroids'] = stars
+        if len(positions) > 1:
+            offset = stars[:,1,:] - stars[:,0,:]
+            out['separation'] = np.hypot(offset[:,0], offset[:,1])
+    if bins is not None:
+        out['profile'] = radial_profiles(images, bins)
+    return out
+
+def analyse_stack(images, reference=None, select=None, size=128, positions=None, window=32,
+                  profiles=False, nbins=None, chunk=256, threads=None):
+    """Astrometric metrics for every image in a stack, in parallel chunks
+
+    Each chunk of images is read once (so memory-mapped stacks, e.g. from
+    sweep.load_sweep, are streamed from disk) and reduced with whole-chunk
+    NumPy operations. Chunks are processed in threads, since NumPy releases
+    the GIL for these reductions and threads share the memory map.
+
+    Parameters
+    ----------
+    images : numpy ndarray
+        Stack of 2D detector images, possibly memory mapped
+
+    reference : numpy ndarray
+        Reference image for residuals, e.g. images[0]
+
+    select : numpy ndarray
+        Indices (or boolean mask, e.g. done from load_sweep) of the images
+        to analyse. Default is all.
+
+    size : int
+        Central viewport size in pixels, for centroids and residuals
+
+    positions : list of tuple
+        Approximate (row, column) of each star, for per-star centroids and,
+        with two stars, their separation
+
+    window : int
+        Window size in pixels for per-star centroids
+
+    profiles : bool
+        Compute radial profiles about the image centre
+
+    nbins : int
+        Number of annuli for radial profiles, as for radial_bins
+
+    chunk : int
+        Images per chunk
+
+    threads : int
+        Number of threads. Default is the number of CPUs.
+
+    Returns
+    -------
+    metrics : dict
+        Arrays indexed by analysed image:
+        'centroid' (n, 2) within the viewport, in image pixels;
+        'sum_sq' and 'rms' viewport residuals against the reference;
+        'star_centroids' (n, nstars, 2) and 'separation' in pixels;
+        'profile' (n, nbins)
+    """
+    index = np.arange(images.shape[0])
+    if select is not None:
+        index = index[select]
+    bins = radial_bins(images.shape[-1], nbins=nbins) if profiles else None
+    if reference is not None:
+        reference = np.asarray(reference, dtype = np.float64)
+
+    def run(start):
+        idx = index[start:start+chunk]
+        # Contiguous chunks are read as slices, which memory maps stream well
+        if idx.size > 0 and idx[-1] - idx[0] == idx.size - 1:
+            block = images[idx[0]:idx[-1]+1]
+        else:
+            block = images[idx]
+        return _analyse_chunk(block, reference, size, positions, window, bins)
+
+    starts = range(0, index.size, chunk)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as executor:
+        parts = list(executor.map(run, starts))
+    if len(parts) == 0:
+        return {}
+    return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
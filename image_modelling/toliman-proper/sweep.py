@@ -0,0 +1,214 @@
+import numpy as np
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from proper_tools import form_detector_image, auto_grid
+from resource_model import predict, run_scheduled
+
+# Fields that belong to a source rather than its PASSVALUE settings
+SOURCE_FIELDS = ('wavelengths', 'weights')
+
+# Files making up a result store
+STORE_INDEX = 'index.json'
+STORE_IMAGES = 'images.npy'
+STORE_DONE = 'done.npy'
+
+def expand_grid(grid):
+    """Expand a declarative parameter grid into a list of points
+
+    Parameters
+    ----------
+    grid : dict or list of dict
+        Either a dict mapping each field to a list of values, in which case
+        every combination is used (outer product, last field varying
+        fastest), or an explicit list of points, each a dict of field values.
+
+        A field name such as 'tilt_x' applies to the settings of every
+        source; prefix with a source index, e.g. '1/tilt_x', to apply to one
+        source only. The names 'wavelengths' and 'weights' set the source
+        entries rather than the settings.
+
+    Returns
+    -------
+    keys : list of str
+        Field names, in order
+
+    points : list of dict
+        One dict of field values per point
+    """
+    if isinstance(grid, dict):
+        keys = list(grid.keys())
+        points = [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+    else:
+        points = [dict(point) for point in grid]
+        keys = []
+        for point in points:
+            keys += [k for k in point if k not in keys]
+    return keys, points
+
+def apply_point(sources, point):
+    """Return a copy of the sources with the field values of a point applied
+
+    Parameters
+    ----------
+    sources : list of dict
+        Sources as passed to form_detector_image
+
+    point : dict
+        Field values, named as for expand_grid
+
+    Returns
+    -------
+    out : list of dict
+        Modified copies of the sources; the originals are unchanged.
+    """
+    out = []
+    for source in sources:
+        source = source.copy()
+        source['settings'] = source['settings'].copy()
+        out.append(source)
+    for key, value in point.items():
+        if '/' in key:
+            index, field = key.split('/', 1)
+            targets = [out[int(index)]]
+        else:
+            field = key
+            targets = out
+        for source in targets:
+            if field in SOURCE_FIELDS:
+                source[field] = value
+            else:
+                source['settings'][field] = value
+    return out
+
+def serialise_index(keys, points):
+    """Parameter index table of a result store, as JSON text"""
+    # Functions (e.g. opd_func) are recorded by name
+    default = lambda o: getattr(o, '__name__', repr(o))
+    return json.dumps({'keys': keys, 'points': [[point.get(k) for k in keys] for point in points]},
+                      default=default, indent=1)
+
+def _run_point(prescription, sources, gridsize, detector_pitch, npixels, multi):
+    return form_detector_image(prescription, sources, gridsize, detector_pitch, npixels, multi=multi)
+
+def run_sweep(path, prescription, sources, grid, gridsize, detector_pitch, npixels,
+              processes=None, multi=False):
+    """Run a parameter sweep of form_detector_image into a single result store
+
+    Detector images are written into one preallocated, memory-mappable array
+    in the directory path, along with a parameter index table and a record of
+    completed points. Points already completed (e.g. before an interruption)
+    are skipped, so the same call resumes a sweep.
+
+    Parameters
+    ----------
+    path : str
+        Directory for the result store; created if needed
+
+    prescription : str
+        Name of the PROPER prescription to run
+
+    sources : list of dict
+        Base sources as passed to form_detector_image
+
+    grid : dict or list of dict
+        Parameter grid, see expand_grid
+
+    gridsize, detector_pitch, npixels :
+        As for form_detector_image
+
+    processes : int
+        Number of worker processes. If 1, points are run in this process.
+        Default is to pack points onto this node's available memory and
+        cores, largest first, by their requirements as predicted by
+        resource_model (see resource_model.run_scheduled).
+
+    multi : bool
+        Use prop_run_multi within each point. Usually only worthwhile with
+        processes=1, since the points themselves are run in parallel.
+
+    Returns
+    -------
+    n : int
+        Number of points computed by this call
+    """
+    keys, points = expand_grid(grid)
+    index = serialise_index(keys, points)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    index_name = os.path.join(path, STORE_INDEX)
+    images_name = os.path.join(path, STORE_IMAGES)
+    done_name = os.path.join(path, STORE_DONE)
+
+    if os.path.exists(index_name):
+        with open(index_name) as f:
+            if f.read() != index:
+                raise ValueError('Result store {} holds a different sweep'.format(path))
+        done = np.load(done_name, mmap_mode='r+')
+    else:
+        with open(index_name, 'w') as f:
+            f.write(index)
+        done = np.lib.format.open_memmap(done_name, mode='w+', dtype=bool, shape=(len(points),))
+        done[:] = False
+        done.flush()
+    images = np.load(images_name, mmap_mode='r+') if os.path.exists(images_name) else None
+
+    def store(i, image):
+        nonlocal images
+        if images is None:
+            images = np.lib.format.open_memmap(images_name, mode='w+', dtype=image.dtype,
+                                               shape=(len(points),)+image.shape)
+        images[i] = image
+        images.flush()
+        # Only mark as done once the image is on disk
+        done[i] = True
+        done.flush()
+
+    todo = [i for i in range(len(points)) if not done[i]]
+    if len(todo) == 0:
+        return 0
+    if processes is None:
+        n = auto_grid(prescription, sources)[0] if gridsize == 'auto' else gridsize
+        jobs = [(prescription, apply_point(sources, points[i]), gridsize, detector_pitch, npixels, multi) for i in todo]
+        predictions = [predict(job[1], n, multi) for job in jobs]
+        run_scheduled(_run_point, jobs, predictions, callback=lambda k, image: store(todo[k], image))
+    elif processes == 1:
+        for i in todo:
+            store(i, _run_point(prescription, apply_point(sources, points[i]), gridsize, detector_pitch, npixels, multi))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(_run_point, prescription, apply_point(sources, points[i]),
+                                       gridsize, detector_pitch, npixels, multi): i for i in todo}
+            for future in as_completed(futures):
+                store(futures[future], future.result())
+    return len(todo)
+
+def load_sweep(path):
+    """Load a sweep result store
+
+    Parameters
+    ----------
+    path : str
+        Directory of the result store
+
+    Returns
+    -------
+    params : dict
+        Maps each field name to an array of its value at each point
+
+    images : numpy ndarray
+        Read-only memory map of detector images, indexed by point
+
+    done : numpy ndarray
+        Boolean array, True for points that have been computed
+    """
+    with open(os.path.join(path, STORE_INDEX)) as f:
+        index = json.load(f)
+    params = {}
+    for j, key in enumerate(index['keys']):
+        params[key] = np.array([point[j] for point in index['points']])
+    done = np.load(os.path.join(path, STORE_DONE))
+    images_name = os.path.join(path, STORE_IMAGES)
+    images = np.load(images_name, mmap_mode='r') if os.path.exists(images_name) else None
+    return params, images, done
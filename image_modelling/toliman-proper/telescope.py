@@ -0,0 +1,323 @@
+"""TOLIMAN telescope description, run through either PROPER or POPPY
+
+Usage: python telescope.py [--config FILE] [--gridsize N] [--backends proper poppy]
+
+With no arguments, benchmarks both backends on an on-axis source at 0.6
+microns and prints the runtime, peak memory and difference from the PROPER
+image of each.
+
+TELESCOPE holds the default optical parameters, which prescription_rc_quad
+also uses. Settings override these as PASSVALUE settings do for the
+prescription. The 'proper' backend runs prescription_rc_quad; the 'poppy'
+backend builds the same system as a poppy.FresnelOpticalSystem at the same
+sampling. Both then form the detector image with the same resampling and
+pixellation as form_detector_image.
+"""
+import argparse
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+from proper_tools import normalise_sampling, combine_psfs, fix_prop_pixellate, select_fft
+
+# Default optical parameters of the TOLIMAN Ritchey-Chretien telescope
+TELESCOPE = {
+             'diam': 0.3,                        # telescope diameter in meters
+             'm1_fl': 0.5717255,                 # primary focal length (m)
+             'm1_hole_rad': 0.035,               # Radius of hole in primary (m)
+             'm1_m2_sep': 0.549337630333726,     # primary to secondary separation (m)
+             'm2_fl': -0.023378959,              # secondary focal length (m)
+             'bfl': 0.528110658881,              # nominal distance from secondary to focus (m)
+             'beam_ratio': 0.2,                  # initial beam width/grid width
+             'm2_rad': 0.059,                    # Secondary half-diameter (m)
+             'm2_strut_width': 0.01,             # Width of struts supporting M2 (m)
+             'm2_supports': 5,                   # Number of support structs (assumed equally spaced)
+             }
+
+PRESCRIPTION = 'prescription_rc_quad'
+BACKENDS = ('proper', 'poppy')
+
+# Settings the POPPY backend can't represent
+POPPY_UNSUPPORTED = ('m1_zernike', 'm2_zernike', 'noabs')
+
+def entrance_transmission(x, y, settings):
+    """Entrance pupil transmission: aperture, M2 obscuration and struts
+
+    As built by prescription_rc_quad, but hard-edged (PROPER anti-aliases).
+
+    Parameters
+    ----------
+    x, y : numpy ndarray
+        Pupil coordinates in metres, x along PROPER's x (array columns)
+
+    settings : dict
+        Telescope settings
+
+    Returns
+    -------
+    transmission : numpy ndarray
+        1 where light passes, 0 elsewhere
+    """
+    s = dict(TELESCOPE, **settings)
+    r = np.hypot(x, y)
+    transmission = ((r <= s['diam']/2) & (r >= s['m2_rad'])).astype(np.float64)
+    strut_length = s['diam']/2 - s['m2_rad']
+    strut_centre = s['m2_rad'] + strut_length/2
+    for i in range(s['m2_supports']):
+        angle = math.radians(i*360/s['m2_supports'])
+        along = x*math.cos(angle) + y*math.sin(angle)
+        across = -x*math.sin(angle) + y*math.cos(angle)
+        transmission[(np.abs(along - strut_centre) <= strut_length/2) & (np.abs(across) <= s['m2_strut_width']/2)] = 0.
+    return transmission
+
+def _poppy_elements():
+    # Define POPPY element classes on first use, so POPPY is only imported
+    # by the poppy backend
+    poppy = lazy_import('poppy')
+
+    class FunctionElement(poppy.AnalyticOpticalElement):
+        """Element with OPD and transmission from functions of (x, y) in
+        PROPER's orientation: x along columns, y along rows"""
+        def __init__(self, name, opd=None, transmission=None):
+            poppy.AnalyticOpticalElement.__init__(self, name=name, planetype=poppy.poppy_core.PlaneType.intermediate)
+            self.opd_func = opd
+            self.transmission_func = transmission
+
+        def get_opd(self, wave):
+            if self.opd_func is None:
+                return np.zeros(wave.shape, dtype = np.float64)
+            y, x = wave.coordinates()
+            return self.opd_func(x, y)
+
+        def get_transmission(self, wave):
+            if self.transmission_func is None:
+                return np.ones(wave.shape, dtype = np.float64)
+            y, x = wave.coordinates()
+            return self.transmission_func(x, y)
+
+    return poppy, FunctionElement
+
+def _polar_opd(opd_func, rmax):
+    # OPD map from an opd_func(r, phi), as gen_opdmap evaluates it, with phi
+    # measured from the first array axis
+    def opd(x, y):
+        r = np.hypot(x, y)
+        inside = r <= rmax
+        out = np.zeros(r.shape, dtype = np.float64)
+        out[inside] = np.vectorize(opd_func)(r[inside], np.arctan2(x[inside], y[inside]))
+        return out
+    return opd
+
+def poppy_system(settings, wavelength, gridsize):
+    """Build the telescope as a POPPY Fresnel optical system
+
+    Mirrors prescription_rc_quad element by element, at the same pupil
+    sampling and a grid of at least gridsize.
+
+    Parameters
+    ----------
+    settings : dict
+        Telescope settings, as PASSVALUE for prescription_rc_quad
+
+    wavelength : float
+        Wavelength in metres
+
+    gridsize : int
+        Size of the wavefront grid
+
+    Returns
+    -------
+    system : poppy.FresnelOpticalSystem
+    """
+    import astropy.units as u
+    poppy, FunctionElement = _poppy_elements()
+    unsupported = [k for k in POPPY_UNSUPPORTED if k in settings]
+    if unsupported:
+        raise ValueError('POPPY backend does not support settings {}'.format(unsupported))
+    s = dict(TELESCOPE, **settings)
+    beam_ratio = s['beam_ratio']
+    if s.get('sampling_wavelength') is not None:
+        beam_ratio *= s['sampling_wavelength'] / wavelength
+    # POPPY pads npix pupil samples by an integer oversample, so take the
+    # largest oversample for which the beam fits, and an even npix so the
+    # padding is even. The grid is then at least gridsize.
+    oversample = max(1, int(math.floor(1./beam_ratio + 1e-9)))
+    npix = 2*int(math.ceil(gridsize / (2.*oversample)))
+    # Same pupil sampling as prop_begin(diam, wavelength, gridsize, beam_ratio)
+    system = poppy.FresnelOpticalSystem(name='TOLIMAN', pupil_diameter=s['diam']*npix/(gridsize*beam_ratio)*u.m,
+                                        npix=npix, beam_ratio=1./oversample)
+
+    # Tilt as in prop_tilt, with x along the first array axis (rows)
+    xangle = s.get('tilt_x', 0.) * np.pi / 648000.
+    yangle = s.get('tilt_y', 0.) * np.pi / 648000.
+    system.add_optic(FunctionElement('Entrance',
+                                     opd=lambda x, y: xangle*y + yangle*x,
+                                     transmission=lambda x, y: entrance_transmission(x, y, s)))
+
+    opd1 = s.get('opd_func', s.get('phase_func'))
+    if opd1 is not None:
+        system.add_optic(FunctionElement('M1 OPD', opd=_polar_opd(opd1, s['diam']/2)), distance=s['m1_m2_sep']*u.m)
+        m1_distance = 0.*u.m
+    else:
+        m1_distance = s['m1_m2_sep']*u.m
+    if 'm1_conic' in s:
+        system.add_optic(poppy.fresnel.ConicLens(f_lens=s['m1_fl']*u.m, K=s['m1_conic'], name='Primary'), distance=m1_distance)
+    else:
+        system.add_optic(poppy.QuadraticLens(s['m1_fl']*u.m, name='Primary'), distance=m1_distance)
+    system.add_optic(poppy.SecondaryObscuration(secondary_radius=s['m1_hole_rad']*u.m, n_supports=0, name='M1 hole'))
+
+    opd2 = s.get('opd_func_sec', s.get('phase_func_sec'))
+    if opd2 is not None:
+        system.add_optic(FunctionElement('M2 OPD', opd=_polar_opd(opd2, s['m2_rad'])), distance=s['m1_m2_sep']*u.m)
+        m2_distance = 0.*u.m
+    else:
+        m2_distance = s['m1_m2_sep']*u.m
+    if 'm1_conic' in s:
+        system.add_optic(poppy.fresnel.ConicLens(f_lens=s['m2_fl']*u.m, K=s['m2_conic'], name='Secondary'), distance=m2_distance)
+    else:
+        system.add_optic(poppy.QuadraticLens(s['m2_fl']*u.m, name='Secondary'), distance=m2_distance)
+    system.add_optic(poppy.CircularAperture(radius=s['m2_rad']*u.m, name='M2 aperture'))
+
+    # Not an image plane, which POPPY would give an angular pixel scale
+    focus = poppy.ScalarTransmission(name='Focus')
+    if s['m1_m2_sep'] < s['bfl']:
+        system.add_optic(poppy.CircularAperture(radius=s['m1_hole_rad']*u.m, name='M1 hole aperture'), distance=s['m1_m2_sep']*u.m)
+        system.add_optic(focus, distance=(s['bfl'] - s['m1_m2_sep'])*u.m)
+    else:
+        system.add_optic(focus, distance=s['bfl']*u.m)
+    return system
+
+def backend_psf(backend, settings, wavelength, gridsize):
+    """Focal plane intensity at one wavelength
+
+    Parameters
+    ----------
+    backend : str
+        'proper' or 'poppy'
+
+    settings : dict
+        Telescope settings
+
+    wavelength : float
+        Wavelength in microns
+
+    gridsize : int
+        Size of the wavefront grid
+
+    Returns
+    -------
+    psf : numpy ndarray
+        Intensity, centred at [n//2, n//2]
+
+    sampling : float
+        Sampling in metres
+    """
+    if backend == 'proper':
+        return proper.prop_run(PRESCRIPTION, wavelength, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+    if backend == 'poppy':
+        import astropy.units as u
+        system = poppy_system(settings, wavelength*1e-6, gridsize)
+        psf, waves = system.calc_psf(wavelength=wavelength*1e-6*u.m, display=False, return_final=True)
+        return waves[-1].intensity, waves[-1].pixelscale.to(u.m/u.pixel).value
+    raise ValueError('Unknown backend "{}"'.format(backend))
+
+def form_image(backend, sources, gridsize, detector_pitch, npixels):
+    """Detector image through either backend
+
+    Parameters
+    ----------
+    backend : str
+        'proper' or 'poppy'
+
+    sources, gridsize, detector_pitch, npixels :
+        As for form_detector_image
+
+    Returns
+    -------
+    image : numpy ndarray
+        Detector image, formed as by form_detector_image
+    """
+    common_sampling = detector_pitch/2.
+    source_psfs = []
+    for source in sources:
+        psfs = []
+        samplings = []
+        for wl in source['wavelengths']:
+            psf, sampling = backend_psf(backend, source['settings'], wl, gridsize)
+            psfs.append(psf)
+            samplings.append(sampling)
+        source_psfs.append(combine_psfs(normalise_sampling(psfs, samplings, common_sampling, 2*npixels), source['weights']))
+    psf_all = combine_psfs(np.stack(source_psfs), [1. for i in range(len(source_psfs))])
+    return fix_prop_pixellate(psf_all, common_sampling, detector_pitch)
+
+def _timed_image(backend, sources, gridsize, detector_pitch, npixels):
+    import resource
+    select_fft()
+    start = time.time()
+    image = form_image(backend, sources, gridsize, detector_pitch, npixels)
+    runtime = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    return image, runtime, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def benchmark(sources, gridsize, detector_pitch, npixels, backends=BACKENDS, size=128):
+    """Time each backend on the same job and compare their images
+
+    Each backend runs in a fresh process, so its peak memory is its own.
+
+    Parameters
+    ----------
+    sources, gridsize, detector_pitch, npixels :
+        As for form_detector_image
+
+    backends : list of str
+        Backends to run; images are compared with the first
+
+    size : int
+        Viewport size in pixels for the image metrics
+
+    Returns
+    -------
+    results : dict
+        For each backend, 'runtime' in seconds, peak 'memory' in bytes, and
+        convergence.image_metrics of its flux-normalised image against the
+        first backend's
+    """
+    from convergence import image_metrics
+    results = {}
+    images = {}
+    for backend in backends:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            image, runtime, memory = executor.submit(_timed_image, backend, sources, gridsize, detector_pitch, npixels).result()
+        images[backend] = image / np.sum(image)
+        results[backend] = {'runtime': runtime, 'memory': memory}
+    for backend in backends:
+        results[backend].update(image_metrics(images[backend], images[backends[0]], size))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the TOLIMAN telescope through PROPER and POPPY')
+    parser.add_argument('--config', help='toliman-sim configuration for the sources and detector')
+    parser.add_argument('--gridsize', type=int, default=1024)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=BACKENDS)
+    args = parser.parse_args(argv)
+    if args.config is not None:
+        from toliman_sim import load_config, build_sources
+        config = load_config(args.config)
+        sources = build_sources(config)
+        pitch = config['detector']['pitch']
+        npixels = config['detector']['npixels']
+    else:
+        sources = [{'wavelengths': [0.6], 'weights': [1.], 'settings': {'beam_ratio': 0.4}}]
+        pitch = 11e-6
+        npixels = 256
+    results = benchmark(sources, args.gridsize, pitch, npixels, args.backends)
+    for backend, r in results.items():
+        print('{:<8} {:8.2f}s {:8.1f} MB  rms {:.2e} centroid {:.2e} peak {:.2e}'.format(
+              backend, r['runtime'], r['memory']/1e6, r['rms'], r['centroid'], r['peak']))
+    print(json.dumps(results, indent=1, default=float))
+
+if __name__ == '__main__':
+    main()
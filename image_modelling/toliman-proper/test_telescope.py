@@ -0,0 +1,56 @@
+"""Check the POPPY backend of telescope.py against PROPER
+
+Run from this directory with: python -m pytest test_telescope.py
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('proper')
+pytest.importorskip('poppy')
+
+import telescope
+import proper_cache
+from convergence import image_metrics
+
+PITCH = 11e-6
+NPIXELS = 64
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path):
+    # Keep PROPER's cached grids out of the working directory; benchmark's
+    # worker processes inherit the setting
+    previous = proper_cache.cache_dir
+    proper_cache.set_cache_dir(str(tmp_path))
+    yield
+    proper_cache.set_cache_dir(previous)
+
+def _sources(beam_ratio):
+    return [{'wavelengths': [0.6], 'weights': [1.], 'settings': {'beam_ratio': beam_ratio}}]
+
+@pytest.mark.parametrize('gridsize, beam_ratio', [(256, 0.2), (512, 0.2), (512, 0.4)])
+def test_poppy_sampling(gridsize, beam_ratio):
+    # Both backends sample the focal plane in metres, scaled by grid size
+    psf, sampling = telescope.backend_psf('poppy', {'beam_ratio': beam_ratio}, 0.6, gridsize)
+    proper_psf, proper_sampling = telescope.backend_psf('proper', {'beam_ratio': beam_ratio}, 0.6, gridsize)
+    assert psf.shape[0] >= gridsize
+    assert sampling * psf.shape[0] == pytest.approx(proper_sampling * gridsize, rel=1e-3)
+
+@pytest.mark.parametrize('gridsize, beam_ratio', [(256, 0.2), (512, 0.4)])
+def test_form_image(gridsize, beam_ratio):
+    image = telescope.form_image('poppy', _sources(beam_ratio), gridsize, PITCH, NPIXELS)
+    reference = telescope.form_image('proper', _sources(beam_ratio), gridsize, PITCH, NPIXELS)
+    assert image.shape == (NPIXELS, NPIXELS)
+    assert np.all(np.isfinite(image))
+    metrics = image_metrics(image / np.sum(image), reference / np.sum(reference), 32)
+    assert metrics['rms'] < 5e-3
+    assert metrics['centroid'] < 0.02
+    assert metrics['peak'] < 0.03
+
+def test_benchmark():
+    results = telescope.benchmark(_sources(0.4), 512, PITCH, NPIXELS, size=32)
+    assert set(results) == set(telescope.BACKENDS)
+    for r in results.values():
+        assert r['runtime'] > 0. and r['memory'] > 0
+    assert results['proper']['rms'] == 0.
+    assert results['poppy']['rms'] < 5e-3
+    assert results['poppy']['centroid'] < 0.02
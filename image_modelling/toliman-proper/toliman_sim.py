@@ -0,0 +1,248 @@
+"""Run TOLIMAN detector image simulations from a configuration file.
+
+Usage: toliman-sim CONFIG [--output DIR] [--processes N] [--fft BACKEND]
+
+The configuration (YAML, JSON or TOML) describes everything that batch
+scripts otherwise set in Python; for example, in YAML:
+
+    prescription: prescription_rc_quad
+    gridsize: 2048                  # or 'auto'
+    settings:                       # PASSVALUE settings shared by all sources
+      diam: 0.3
+      beam_ratio: 0.4
+      opd_func: {function: spirals.binarized_ringed_flipped, phase: 3.25e-7}
+    spectrum:                       # explicit wavelengths (microns) and weights
+      wavelengths: [0.6, 0.61, 0.62]
+      weights: [0.3, 0.4, 0.3]
+                                    # or filter/star files and a number of
+                                    # quadrature wavelengths:
+                                    # {filter: f.txt, star: s.txt, n: 6}
+    sources:                        # settings overrides, and relative flux
+      - {flux: 3.4}
+      - {tilt_x: 3.0, tilt_y: 1.0}
+    detector: {pitch: 11.0e-6, npixels: 512}
+    sweep:                          # optional; see sweep.expand_grid
+      grid: {'1/tilt_x': [3.0, 3.000001]}
+      warm_cache: true
+    run:
+      processes: 4
+      multi: false
+      fft: numpy                    # numpy, fftw or intel (with mkl_dir)
+      use_caching: true
+      cache_dir: /shared/cache
+    output: results
+
+A single image is written to image.npy in the output directory, or a sweep
+to a result store there (see sweep.load_sweep), along with timing.json.
+"""
+import argparse
+import functools
+import importlib
+import json
+import os
+import sys
+import time
+from lazy_import import lazy_import
+np = lazy_import('numpy')
+proper = lazy_import('proper')
+
+def load_config(filename):
+    """Read a YAML, JSON or TOML configuration file, by extension"""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        import yaml
+        with open(filename) as f:
+            return yaml.safe_load(f)
+    if ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(filename, 'rb') as f:
+            return tomllib.load(f)
+    with open(filename) as f:
+        return json.load(f)
+
+def resolve_function(spec):
+    """Turn a function description into a callable
+
+    Parameters
+    ----------
+    spec : str or dict
+        'module.function', or a dict with 'function' and any keyword
+        arguments to fix, e.g. {'function': 'spirals.binarized_ringed',
+        'phase': 3.25e-7}
+
+    Returns
+    -------
+    func : function
+        The function, with a __name__ that identifies any fixed arguments
+        (used in cache names)
+    """
+    if isinstance(spec, str):
+        spec = {'function': spec}
+    kwargs = dict(spec)
+    module, name = kwargs.pop('function').rsplit('.', 1)
+    func = getattr(importlib.import_module(module), name)
+    if len(kwargs) == 0:
+        return func
+    partial = functools.partial(func, **kwargs)
+    partial.__name__ = '_'.join([name] + ['{}{}'.format(k, kwargs[k]) for k in sorted(kwargs)])
+    return partial
+
+# Settings that name functions
+FUNCTION_SETTINGS = ('opd_func', 'opd_func_sec', 'phase_func', 'phase_func_sec')
+
+def build_sources(config):
+    """Build form_detector_image sources from a configuration"""
+    settings = dict(config.get('settings', {}))
+    for key in FUNCTION_SETTINGS:
+        if key in settings:
+            settings[key] = resolve_function(settings[key])
+    run = config.get('run', {})
+    if 'use_caching' in run:
+        settings['use_caching'] = run['use_caching']
+
+    spectrum = config['spectrum']
+    if 'wavelengths' in spectrum:
+        wavelengths = list(spectrum['wavelengths'])
+        weights = list(spectrum['weights'])
+    else:
+        from spectral import spectral_weights, gauss_quadrature
+        wl, w = spectral_weights(spectrum['filter'], None, spectrum.get('star'), None,
+                                 photon=spectrum.get('photon', True))
+        nodes, node_weights = gauss_quadrature(wl, w, spectrum.get('n', 8))
+        wavelengths = [float(x) for x in nodes]
+        weights = [float(x) for x in node_weights]
+
+    sources = []
+    for source in config.get('sources', [{}]):
+        source = dict(source)
+        flux = source.pop('flux', 1.)
+        sources.append({'wavelengths': wavelengths,
+                        'weights': [flux*w for w in weights],
+                        'settings': dict(settings, **source)})
+    return sources
+
+def select_fft(backend, gridsize, mkl_dir=None):
+    """Select the PROPER FFT backend for this run: 'numpy', 'fftw' or 'intel'
+
+    See proper_tools.select_fft; the choice is not saved for later runs.
+
+    Returns
+    -------
+    previous : tuple
+        The backend selected before and the TOLIMAN_FFT setting, for
+        restore_fft
+    """
+    import proper_tools
+    environment = os.environ.get(proper_tools.fft_environment)
+    previous = proper_tools.select_fft(backend, mkl_dir)
+    if backend == 'fftw' and gridsize != 'auto':
+        proper.prop_fftw_wisdom(gridsize)
+    return previous, environment
+
+def restore_fft(previous):
+    """Restore the PROPER FFT backend returned by select_fft"""
+    import proper_tools
+    backend, environment = previous
+    # Already checked when it was selected
+    proper.use_fftw = backend in ('fftw', 'intel')
+    proper.use_ffti = backend == 'intel'
+    if environment is None:
+        del os.environ[proper_tools.fft_environment]
+    else:
+        os.environ[proper_tools.fft_environment] = environment
+
+def run(config, output=None, processes=None, fft=None):
+    """Run the simulation described by a configuration
+
+    Parameters
+    ----------
+    config : dict
+        Configuration, as described in the module docstring
+
+    output, processes, fft :
+        Override the configured output directory, worker processes and FFT
+        backend
+
+    Returns
+    -------
+    timing : dict
+        Wall-clock times in seconds of each stage, and the settings used
+    """
+    start = time.time()
+    run_config = dict(config.get('run', {}))
+    if processes is not None:
+        run_config['processes'] = processes
+    if fft is not None:
+        run_config['fft'] = fft
+    output = output or config.get('output', '.')
+    if not os.path.exists(output):
+        os.makedirs(output)
+
+    if 'cache_dir' in run_config:
+        from proper_cache import set_cache_dir
+        set_cache_dir(run_config['cache_dir'], run_config.get('cache_max_bytes'))
+    prescription = config.get('prescription', 'prescription_rc_quad')
+    gridsize = config.get('gridsize', 2048)
+    previous_fft = None
+    if 'fft' in run_config:
+        previous_fft = select_fft(run_config['fft'], gridsize, run_config.get('mkl_dir'))
+    try:
+        return _run(config, run_config, output, prescription, gridsize, start)
+    finally:
+        if previous_fft is not None:
+            restore_fft(previous_fft)
+
+def _run(config, run_config, output, prescription, gridsize, start):
+    sources = build_sources(config)
+    pitch = config['detector']['pitch']
+    npixels = config['detector']['npixels']
+    multi = run_config.get('multi', True)
+    timing = {'prescription': prescription, 'gridsize': gridsize, 'run': run_config,
+              'setup': time.time() - start}
+
+    sweep = config.get('sweep')
+    if sweep is None:
+        from proper_tools import form_detector_image
+        t = time.time()
+        image = form_detector_image(prescription, sources, gridsize, pitch, npixels, multi=multi)
+        timing['image'] = time.time() - t
+        np.save(os.path.join(output, 'image.npy'), image)
+    else:
+        from sweep import run_sweep
+        if sweep.get('warm_cache', False):
+            from warmup import warm_cache
+            t = time.time()
+            timing['warm_configurations'] = warm_cache(prescription, sources, sweep['grid'], gridsize,
+                                                       processes=run_config.get('processes'))
+            timing['warm_cache'] = time.time() - t
+        t = time.time()
+        n = run_sweep(output, prescription, sources, sweep['grid'], gridsize, pitch, npixels,
+                      processes=run_config.get('processes'), multi=multi)
+        timing['sweep'] = time.time() - t
+        timing['points'] = n
+        if n > 0:
+            timing['per_point'] = timing['sweep'] / n
+    timing['total'] = time.time() - start
+    with open(os.path.join(output, 'timing.json'), 'w') as f:
+        json.dump(timing, f, indent=1, default=str)
+    return timing
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='toliman-sim', description='Run TOLIMAN detector image simulations')
+    parser.add_argument('config', help='YAML, JSON or TOML configuration file')
+    parser.add_argument('--output', help='output directory (overrides config)')
+    parser.add_argument('--processes', type=int, help='worker processes (overrides config)')
+    parser.add_argument('--fft', choices=['numpy', 'fftw', 'intel'], help='FFT backend (overrides config)')
+    args = parser.parse_args(argv)
+    # Prescriptions and configured functions are imported by name
+    sys.path.insert(0, os.getcwd())
+    timing = run(load_config(args.config), args.output, args.processes, args.fft)
+    for key in ('setup', 'warm_cache', 'image', 'sweep', 'per_point', 'total'):
+        if key in timing:
+            print('{:<10} {:10.3f}s'.format(key, timing[key]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+from concurrent.futures import ProcessPoolExecutor
+from sweep import expand_grid, apply_point
+from proper_tools import auto_grid, select_fft
+
+# Settings that have no effect on any cached grid (Zernike coefficients only
+# weight a cached basis)
+UNCACHED_SETTINGS = ('tilt_x', 'tilt_y', 'noabs', 'use_caching', 'm1_zernike', 'm2_zernike')
+
+def _setting_key(value):
+    # Functions (e.g. opd_func) are identified by name, as in the cache names
+    if callable(value):
+        return '{}.{}'.format(getattr(value, '__module__', ''), getattr(value, '__name__', repr(value)))
+    if isinstance(value, list):
+        return tuple(_setting_key(v) for v in value)
+    return value
+
+def cache_configurations(sources, grid, gridsize, prescription=None):
+    """Find the distinct configurations that build cached grids in a sweep
+
+    Cached grids depend on the optical geometry, wavelength and gridsize, but
+    not on pointing, so points differing only in those settings share the
+    same grids.
+
+    Parameters
+    ----------
+    sources : list of dict
+        Base sources, as passed to form_detector_image
+
+    grid : dict or list of dict
+        Parameter grid, see sweep.expand_grid. May be empty.
+
+    gridsize : int, str or list
+        Gridsize(s) the sweep will be run at, each an int or 'auto' for the
+        configuration recommended for the prescription (see
+        proper_tools.auto_grid)
+
+    prescription : str
+        Name of the PROPER prescription, needed for 'auto' gridsizes
+
+    Returns
+    -------
+    configs : list of tuple
+        Distinct (settings, wavelength, gridsize) combinations
+    """
+    gridsizes = gridsize if isinstance(gridsize, (list, tuple)) else [gridsize]
+    keys, points = expand_grid(grid)
+    configs = {}
+    for n in gridsizes:
+        # 'auto' also sets the beam ratio, as in form_psf
+        n, base = auto_grid(prescription, sources) if n == 'auto' else (n, sources)
+        for point in points or [{}]:
+            for source in apply_point(base, point):
+                settings = {k: v for k, v in source['settings'].items() if k not in UNCACHED_SETTINGS}
+                settings_key = tuple(sorted((k, _setting_key(v)) for k, v in settings.items()))
+                for wavelength in source['wavelengths']:
+                    configs.setdefault((settings_key, wavelength, n), (settings, wavelength, n))
+    return list(configs.values())
+
+def _warm_one(prescription, settings, wavelength, gridsize):
+    select_fft()
+    settings = dict(settings, use_caching=True)
+    proper.prop_run(prescription, wavelength, gridsize = gridsize, QUIET=True, PRINT_INTENSITY=False, PASSVALUE=settings)
+
+def warm_cache(prescription, sources, grid, gridsize, processes=None):
+    """Build every cached grid a sweep will use, ahead of the sweep
+
+    Runs the prescription once for each distinct configuration found by
+    cache_configurations, in parallel. Grids shared between configurations
+    (such as the entrance obstruction) are computed once, with the other
+    workers waiting on the cache lock. The sweep can then run entirely on
+    cache hits, provided its settings enable 'use_caching'.
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+
+    sources, grid, gridsize :
+        Sweep definition, as for cache_configurations
+
+    processes : int
+        Number of worker processes. Default is the number of CPUs.
+
+    Returns
+    -------
+    n : int
+        Number of configurations run
+    """
+    configs = cache_configurations(sources, grid, gridsize, prescription)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_warm_one, prescription, settings, wavelength, n)
+                   for (settings, wavelength, n) in configs]
+        for future in futures:
+            future.result()
+    return len(configs)
@@ -0,0 +1,336 @@
+"""Sharded sweep execution through a work queue on a shared filesystem
+
+Usage: python work_queue.py worker PATH [--lease SECONDS] [--retries N]
+       python work_queue.py status PATH
+       python work_queue.py merge PATH
+
+A sweep is queued once with init_queue, then any number of workers (one or
+more per node) claim points and run them until none are left, and finally
+merge collects the results into a single result store at PATH (see
+sweep.load_sweep). The layout under PATH is:
+
+    queue/job.pkl       sweep definition
+    queue/index.json    parameter index table
+    queue/todo/N        points waiting to run, holding their attempt count
+    queue/claimed/N.W   points claimed by worker W
+    queue/done/N        points completed
+    queue/failed/N      points that failed every attempt, with the error
+    shards/W/N.npy      image of point N, written by worker W
+
+Points are claimed by renaming them from todo to claimed, which succeeds for
+exactly one worker. Workers renew their claims' modification times as a
+heartbeat while running them; a claim not renewed within the lease time is
+returned to todo, so points held by dead workers are run again. Lease times
+should allow for clock differences between nodes.
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import shutil
+import socket
+import threading
+import time
+import traceback
+import glob
+import numpy as np
+from sweep import expand_grid, apply_point, serialise_index, STORE_INDEX, STORE_IMAGES, STORE_DONE
+from proper_tools import form_detector_image
+
+QUEUE_DIR = 'queue'
+SHARDS_DIR = 'shards'
+JOB_FILE = 'job.pkl'
+
+def _queue(path, *parts):
+    return os.path.join(path, QUEUE_DIR, *parts)
+
+def _write_atomic(filename, text):
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, filename)
+
+def init_queue(path, prescription, sources, grid, gridsize, detector_pitch, npixels, multi=False):
+    """Queue the points of a sweep, unless already queued
+
+    Safe to call from every node: the queue is built in a private directory
+    and renamed into place, so exactly one call creates it.
+
+    Parameters
+    ----------
+    path : str
+        Directory on a shared filesystem for the queue, shards and result
+        store; created if needed
+
+    prescription, sources, grid, gridsize, detector_pitch, npixels, multi :
+        As for sweep.run_sweep
+
+    Returns
+    -------
+    created : bool
+        True if this call created the queue
+
+    Raises
+    ------
+    ValueError
+        If a different sweep is already queued at path
+    """
+    keys, points = expand_grid(grid)
+    index = serialise_index(keys, points)
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    if not os.path.exists(_queue(path)):
+        tmp = os.path.join(path, '.{}.{}.{}'.format(QUEUE_DIR, socket.gethostname(), os.getpid()))
+        for sub in ('todo', 'claimed', 'done', 'failed'):
+            os.makedirs(os.path.join(tmp, sub))
+        with open(os.path.join(tmp, JOB_FILE), 'wb') as f:
+            pickle.dump({'prescription': prescription, 'sources': sources, 'grid': grid, 'gridsize': gridsize,
+                         'detector_pitch': detector_pitch, 'npixels': npixels, 'multi': multi}, f)
+        with open(os.path.join(tmp, STORE_INDEX), 'w') as f:
+            f.write(index)
+        for i in range(len(points)):
+            with open(os.path.join(tmp, 'todo', '{:08d}'.format(i)), 'w') as f:
+                f.write('0')
+        try:
+            os.rename(tmp, _queue(path))
+            return True
+        except OSError:
+            # Another node queued it first
+            shutil.rmtree(tmp)
+    with open(_queue(path, STORE_INDEX)) as f:
+        if f.read() != index:
+            raise ValueError('Queue {} holds a different sweep'.format(path))
+    return False
+
+def queue_status(path):
+    """Number of points in each state: todo, claimed, done and failed"""
+    return {state: len([f for f in os.listdir(_queue(path, state)) if not f.endswith('.tmp')])
+            for state in ('todo', 'claimed', 'done', 'failed')}
+
+def requeue_expired(path, lease):
+    """Return claims not renewed within lease seconds to todo
+
+    Returns
+    -------
+    n : int
+        Number of points returned
+    """
+    n = 0
+    now = time.time()
+    for claim in glob.glob(_queue(path, 'claimed', '*')):
+        if claim.endswith('.tmp'):
+            continue
+        try:
+            if now - os.path.getmtime(claim) <= lease:
+                continue
+            # Only one worker's rename succeeds
+            os.rename(claim, _queue(path, 'todo', os.path.basename(claim).split('.')[0]))
+            n += 1
+        except OSError:
+            pass
+    return n
+
+def _claim(path, worker):
+    items = [f for f in os.listdir(_queue(path, 'todo')) if not f.endswith('.tmp')]
+    # Start at a random point, so workers starting together rarely collide
+    random.shuffle(items)
+    for item in items:
+        claim = _queue(path, 'claimed', '{}.{}'.format(item, worker))
+        try:
+            os.rename(_queue(path, 'todo', item), claim)
+        except OSError:
+            continue
+        os.utime(claim)
+        return int(item), claim
+    return None, None
+
+class _Heartbeat(threading.Thread):
+    # Renew a claim until stopped; lost is set if the claim was taken back
+    def __init__(self, claim, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.claim = claim
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                os.utime(self.claim)
+            except OSError:
+                self.lost = True
+                return
+
+def run_worker(path, worker=None, lease=600., max_retries=2, poll=10.):
+    """Claim and run queued points until the queue is finished
+
+    Parameters
+    ----------
+    path : str
+        Directory of a queue created by init_queue
+
+    worker : str
+        Worker name, unique across nodes. Default is hostname-pid.
+
+    lease : float
+        Seconds after which a claim not renewed is presumed dead. Claims are
+        renewed every lease/4 seconds.
+
+    max_retries : int
+        Times a failing point is run again before it is marked failed
+
+    poll : float
+        Seconds to wait between checks when the remaining points are all
+        claimed by other workers
+
+    Returns
+    -------
+    n : int
+        Number of points this worker completed
+    """
+    worker = worker or '{}-{}'.format(socket.gethostname(), os.getpid())
+    with open(_queue(path, JOB_FILE), 'rb') as f:
+        job = pickle.load(f)
+    keys, points = expand_grid(job['grid'])
+    shard = os.path.join(path, SHARDS_DIR, worker)
+    os.makedirs(shard, exist_ok=True)
+    n = 0
+    while True:
+        i, claim = _claim(path, worker)
+        if i is None:
+            requeue_expired(path, lease)
+            i, claim = _claim(path, worker)
+        if i is None:
+            if len(os.listdir(_queue(path, 'claimed'))) == 0:
+                return n
+            time.sleep(poll)
+            continue
+
+        heartbeat = _Heartbeat(claim, lease/4.)
+        heartbeat.start()
+        try:
+            image = form_detector_image(job['prescription'], apply_point(job['sources'], points[i]), job['gridsize'],
+                                        job['detector_pitch'], job['npixels'], multi=job['multi'])
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+        heartbeat.stopped.set()
+        heartbeat.join()
+        item = '{:08d}'.format(i)
+
+        if error is None:
+            tmp = os.path.join(shard, '{}.{}.tmp'.format(item, os.getpid()))
+            with open(tmp, 'wb') as f:
+                np.save(f, image)
+            os.replace(tmp, os.path.join(shard, item + '.npy'))
+            try:
+                os.rename(claim, _queue(path, 'done', item))
+                n += 1
+            except OSError:
+                # Lease lost; another worker will (harmlessly) repeat the point
+                pass
+            continue
+
+        if heartbeat.lost:
+            # The point is already back in the queue
+            continue
+        try:
+            with open(claim) as f:
+                attempts = int(f.read() or 0) + 1
+        except (OSError, ValueError):
+            # Lease lost; the point is already back in the queue
+            continue
+        if attempts > max_retries:
+            _write_atomic(claim, error)
+            target = _queue(path, 'failed', item)
+        else:
+            _write_atomic(claim, str(attempts))
+            target = _queue(path, 'todo', item)
+        try:
+            os.rename(claim, target)
+        except OSError:
+            pass
+
+def merge(path):
+    """Merge the worker shards into a single result store at path
+
+    The store has the layout written by sweep.run_sweep, so can be read
+    with sweep.load_sweep. Points not yet done are left unmarked, and merge
+    can be run again once they are.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the queue
+
+    Returns
+    -------
+    n : int
+        Number of points in the store
+    """
+    shutil.copyfile(_queue(path, STORE_INDEX), os.path.join(path, STORE_INDEX))
+    with open(_queue(path, STORE_INDEX)) as f:
+        npoints = len(json.load(f)['points'])
+    images = None
+    done = np.lib.format.open_memmap(os.path.join(path, STORE_DONE), mode='w+', dtype=bool, shape=(npoints,))
+    done[:] = False
+    for item in os.listdir(_queue(path, 'done')):
+        i = int(item)
+        # Any shard's image will do; a point repeated after a lost lease
+        # gives the same image
+        shards = glob.glob(os.path.join(path, SHARDS_DIR, '*', item + '.npy'))
+        if len(shards) == 0:
+            continue
+        image = np.load(shards[0], mmap_mode='r')
+        if images is None:
+            images = np.lib.format.open_memmap(os.path.join(path, STORE_IMAGES), mode='w+', dtype=image.dtype,
+                                               shape=(npoints,)+image.shape)
+        images[i] = image
+        done[i] = True
+    if images is not None:
+        images.flush()
+    done.flush()
+    return int(np.count_nonzero(done))
+
+def run_local(path, workers, lease=600., max_retries=2):
+    """Run a queue with several local processes standing in for nodes
+
+    Parameters
+    ----------
+    path : str
+        Directory of a queue created by init_queue
+
+    workers : int
+        Number of worker processes
+
+    lease, max_retries :
+        As for run_worker
+
+    Returns
+    -------
+    counts : list of int
+        Points completed by each worker
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_worker, path, '{}-local{}'.format(socket.gethostname(), k), lease, max_retries, 1.)
+                   for k in range(workers)]
+        return [future.result() for future in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run or inspect a sharded sweep queue')
+    parser.add_argument('command', choices=['worker', 'status', 'merge'])
+    parser.add_argument('path', help='queue directory')
+    parser.add_argument('--lease', type=float, default=600., help='seconds before an unrenewed claim expires')
+    parser.add_argument('--retries', type=int, default=2, help='retries of a failing point')
+    args = parser.parse_args(argv)
+    if args.command == 'worker':
+        print('Completed {} points'.format(run_worker(args.path, lease=args.lease, max_retries=args.retries)))
+    elif args.command == 'status':
+        print(json.dumps(queue_status(args.path), indent=1))
+    else:
+        print('Merged {} points'.format(merge(args.path)))
+
+if __name__ == '__main__':
+    main()
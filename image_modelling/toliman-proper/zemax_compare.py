@@ -0,0 +1,218 @@
+import numpy as np
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from proper_tools import form_detector_image, normalise_sampling, fix_prop_pixellate
+from convergence import image_metrics
+
+def load_reference(filename, spacing=None):
+    """Memory map a Zemax PSF converted by zemax_examples/import_zemax.py
+
+    Parameters
+    ----------
+    filename : str
+        Converted .npy file
+
+    spacing : float
+        Sampling of the PSF in metres. Default is the spacing recorded from
+        the export header in the .json file alongside.
+
+    Returns
+    -------
+    psf : numpy ndarray
+        Read-only memory map of the PSF, centred at [n//2, n//2]
+
+    spacing : float
+        Sampling in metres
+    """
+    base = os.path.splitext(filename)[0]
+    psf = np.load(base + '.npy', mmap_mode='r')
+    if spacing is None:
+        with open(base + '.json') as f:
+            spacing = json.load(f)['spacing']
+    return psf, spacing
+
+def reference_image(psf, spacing, detector_pitch, npixels):
+    """Resample a reference PSF onto the detector, as form_detector_image does
+
+    Only the region of the PSF that falls on the detector is read, so large
+    memory-mapped exports are cheap to resample. The PSF is resampled to
+    Nyquist sampling for the detector, then integrated over pixels with
+    fix_prop_pixellate, the same pixellation model used for PROPER images.
+
+    Parameters
+    ----------
+    psf : numpy ndarray
+        Square PSF centred at [n//2, n//2], e.g. from load_reference
+
+    spacing : float
+        Sampling of psf in metres
+
+    detector_pitch, npixels :
+        As for form_detector_image
+
+    Returns
+    -------
+    image : numpy ndarray
+        Detector image of dimension npixels
+    """
+    common_sampling = detector_pitch/2.
+    npsf = npixels*2
+    n = psf.shape[0]
+    # Crop to the detector, with a margin for interpolation
+    half = int(np.ceil(npsf * common_sampling / spacing / 2.)) + 4
+    if 2*half < n:
+        lo = n//2 - half
+        psf = psf[lo:lo+2*half, lo:lo+2*half]
+    nyquist = normalise_sampling([np.asarray(psf, dtype = np.float64)], [spacing], common_sampling, npsf)[0]
+    return fix_prop_pixellate(nyquist, common_sampling, detector_pitch)
+
+def _upsampled_dft(data, region, upsample, offsets):
+    # Cross-correlation from its spectrum, on a region of an upsampled grid
+    for n, offset in zip(data.shape[::-1], offsets[::-1]):
+        kernel = np.exp(-2j*np.pi * (np.arange(region) - offset)[:,np.newaxis] * np.fft.fftfreq(n, upsample))
+        data = np.tensordot(kernel, data, axes=(1, -1))
+    return data
+
+def register(image, reference, upsample=20):
+    """Sub-pixel shift registering an image with a reference
+
+    Cross-correlates in Fourier space, then refines the correlation peak by
+    evaluating the upsampled cross-correlation with a matrix-multiply DFT
+    over a small neighbourhood only (Guizar-Sicairos et al. 2008).
+
+    Parameters
+    ----------
+    image, reference : numpy ndarray
+        Images of the same dimensions
+
+    upsample : int
+        Registration precision is 1/upsample pixels
+
+    Returns
+    -------
+    shift : numpy ndarray
+        (row, column) shift in pixels which, applied to image with
+        shift_image, aligns it with reference
+    """
+    product = np.fft.fft2(reference) * np.conj(np.fft.fft2(image))
+    correlation = np.abs(np.fft.ifft2(product))
+    peak = np.array(np.unravel_index(np.argmax(correlation), correlation.shape), dtype = np.float64)
+    shape = np.array(correlation.shape)
+    peak[peak > shape//2] -= shape[peak > shape//2]
+    if upsample <= 1:
+        return peak
+    shift = np.round(peak * upsample) / upsample
+    region = int(np.ceil(upsample * 1.5))
+    centre = region//2
+    upsampled = np.abs(_upsampled_dft(np.conj(product), region, upsample, centre - shift*upsample))
+    fine = np.array(np.unravel_index(np.argmax(upsampled), upsampled.shape), dtype = np.float64)
+    return shift + (fine - centre) / upsample
+
+def shift_image(image, shift):
+    """Shift an image by a sub-pixel amount, with a Fourier phase ramp"""
+    ramp = np.exp(-2j*np.pi * shift[0] * np.fft.fftfreq(image.shape[0]))[:,np.newaxis] \
+         * np.exp(-2j*np.pi * shift[1] * np.fft.fftfreq(image.shape[1]))[np.newaxis,:]
+    return np.real(np.fft.ifft2(np.fft.fft2(image) * ramp))
+
+def compare_images(image, reference, upsample=20, size=128):
+    """Register an image with a reference and measure the residuals
+
+    Parameters
+    ----------
+    image : numpy ndarray
+        Detector image, e.g. from form_detector_image
+
+    reference : numpy ndarray
+        Reference detector image of the same dimensions, e.g. from
+        reference_image
+
+    upsample : int
+        As for register
+
+    size : int
+        Viewport size in pixels for the metrics
+
+    Returns
+    -------
+    metrics : dict
+        As for convergence.image_metrics, after registration and scaling
+        image to the reference flux, with the 'shift' applied in pixels and
+        the 'flux_ratio' of image to reference
+    """
+    flux_ratio = np.sum(image) / np.sum(reference)
+    shift = register(image, reference, upsample)
+    aligned = shift_image(image, shift) / flux_ratio
+    metrics = image_metrics(aligned, reference, size)
+    metrics['shift'] = shift.tolist()
+    metrics['flux_ratio'] = float(flux_ratio)
+    return metrics
+
+def _model_image(prescription, sources, gridsize, detector_pitch, npixels, multi):
+    return form_detector_image(prescription, sources, gridsize, detector_pitch, npixels, multi=multi)
+
+def compare_batch(prescription, configurations, references, gridsize, detector_pitch, npixels,
+                  pairs=None, processes=None, multi=False, upsample=20, size=128):
+    """Compare PROPER images with a set of Zemax references
+
+    Each configuration is propagated once, in parallel, and each reference
+    is resampled once, however many comparisons use them.
+
+    Parameters
+    ----------
+    prescription : str
+        Name of the PROPER prescription to run
+
+    configurations : dict
+        Maps a name to a list of sources, as passed to form_detector_image
+
+    references : list of str, or dict
+        Converted Zemax PSF filenames, or a dict mapping filenames to their
+        spacing in metres where it was not recorded on conversion
+
+    gridsize, detector_pitch, npixels :
+        As for form_detector_image
+
+    pairs : list of tuple
+        (configuration name, reference filename) pairs to compare. Default
+        is every configuration with every reference.
+
+    processes : int
+        Number of worker processes for propagation. If 1, configurations are
+        run in this process. Default is the number of CPUs.
+
+    multi : bool
+        As for form_detector_image; usually only worthwhile with processes=1
+
+    upsample, size :
+        As for compare_images
+
+    Returns
+    -------
+    results : list of dict
+        Metrics from compare_images for each pair, with its 'configuration'
+        and 'reference'
+    """
+    if not isinstance(references, dict):
+        references = {filename: None for filename in references}
+    if pairs is None:
+        pairs = [(name, filename) for name in configurations for filename in references]
+    names = sorted(set(name for name, filename in pairs))
+    if processes == 1:
+        images = {name: _model_image(prescription, configurations[name], gridsize, detector_pitch, npixels, multi)
+                  for name in names}
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {name: executor.submit(_model_image, prescription, configurations[name],
+                                             gridsize, detector_pitch, npixels, multi) for name in names}
+            images = {name: future.result() for name, future in futures.items()}
+
+    resampled = {}
+    results = []
+    for name, filename in pairs:
+        if filename not in resampled:
+            psf, spacing = load_reference(filename, references.get(filename))
+            resampled[filename] = reference_image(psf, spacing, detector_pitch, npixels)
+        metrics = compare_images(images[name], resampled[filename], upsample, size)
+        results.append(dict(metrics, configuration=name, reference=filename))
+    return results
@@ -0,0 +1,235 @@
+import math
+import numpy as np
+from collections import OrderedDict
+from lazy_import import lazy_import
+proper = lazy_import('proper')
+from coordinates import coordinates
+from proper_cache import load_cacheable_grid
+
+# Basis stacks for the most recently used (nterms, ngrid, sampling, radius)
+max_bases = 2
+_bases = OrderedDict()
+
+def noll_index(j):
+    """Radial order n and azimuthal frequency m of Noll Zernike index j
+
+    Parameters
+    ----------
+    j : int
+        Noll index, from 1 (piston); 2 and 3 are tilts, 4 is defocus and
+        11 is primary spherical aberration
+
+    Returns
+    -------
+    n, m : int
+        Radial order, and signed azimuthal frequency (negative for sine
+        terms)
+    """
+    n = 0
+    while (n + 1)*(n + 2)//2 < j:
+        n += 1
+    m = 2*((j - n*(n + 1)//2 + n % 2)//2) - n % 2
+    return n, (m if m == 0 or j % 2 == 0 else -m)
+
+def zernike(j, r, phi, radius):
+    """Noll-normalised Zernike polynomial, zero outside the pupil
+
+    Parameters
+    ----------
+    j : int
+        Noll index
+
+    r, phi : numpy ndarray
+        Polar coordinates, e.g. from coordinates()
+
+    radius : float
+        Pupil radius, in the same units as r
+
+    Returns
+    -------
+    z : numpy ndarray
+        Polynomial with unit RMS over the pupil
+    """
+    n, m = noll_index(j)
+    rho = r / radius
+    radial = np.zeros(rho.shape, dtype = np.float64)
+    for k in range((n - abs(m))//2 + 1):
+        coeff = (-1)**k * math.factorial(n - k) / (math.factorial(k) * math.factorial((n + abs(m))//2 - k)
+                                                  * math.factorial((n - abs(m))//2 - k))
+        radial += coeff * rho**(n - 2*k)
+    if m == 0:
+        z = math.sqrt(n + 1) * radial
+    elif m > 0:
+        z = math.sqrt(2*(n + 1)) * radial * np.cos(m*phi)
+    else:
+        z = math.sqrt(2*(n + 1)) * radial * np.sin(-m*phi)
+    z[rho > 1.] = 0.
+    return z
+
+def _box(ngrid, sampling, radius):
+    # Centred index range enclosing the pupil, as for gen_opdmap's rmax
+    c = ngrid//2
+    half = int(math.ceil(radius/sampling)) + 1
+    return max(0, c - half), min(ngrid, c + half + 1)
+
+def build_basis(nterms, ngrid, sampling, radius):
+    """Stack of Zernike polynomials over the box enclosing the pupil
+
+    Parameters
+    ----------
+    nterms : int
+        Number of terms, Noll indices 1 to nterms
+
+    ngrid : int
+        Size of (square) grid for wavefront
+
+    sampling : float
+        Grid sampling in metres
+
+    radius : float
+        Pupil radius in metres
+
+    Returns
+    -------
+    basis : numpy ndarray
+        Array of shape (nterms, m, m) over the centred box enclosing the
+        pupil (see zernike_support)
+    """
+    lo, hi = _box(ngrid, sampling, radius)
+    r = coordinates(ngrid, sampling, 'r')[lo:hi, lo:hi]
+    phi = coordinates(ngrid, sampling, 'phi')[lo:hi, lo:hi]
+    basis = np.empty((nterms, hi - lo, hi - lo), dtype = np.float64)
+    for j in range(1, nterms + 1):
+        basis[j - 1] = zernike(j, r, phi, radius)
+    return basis
+
+def zernike_basis(wfo, nterms, radius, use_caching=True):
+    """Zernike basis for a wavefront, computed once per grid and pupil
+
+    Bases are kept in memory for the most recently used few (nterms, ngrid,
+    sampling, radius), and with caching on are also stored in the grid cache
+    (see proper_cache), so other processes load rather than recompute them.
+
+    Parameters
+    ----------
+    wfo : obj
+        WaveFront class object, for the grid size and sampling
+
+    nterms : int
+        Number of terms, Noll indices 1 to nterms
+
+    radius : float
+        Pupil radius in metres
+
+    use_caching : bool
+        Use the grid cache
+
+    Returns
+    -------
+    basis : numpy ndarray
+        Basis stack, from build_basis
+    """
+    ngrid = proper.prop_get_gridsize(wfo)
+    sampling = proper.prop_get_sampling(wfo)
+    key = (int(nterms), int(ngrid), float(sampling), float(radius))
+    if key in _bases:
+        _bases.move_to_end(key)
+        return _bases[key]
+    def build():
+        return build_basis(nterms, ngrid, sampling, radius)
+    basis = load_cacheable_grid('zernike{}_{}'.format(nterms, radius), wfo, build, use_caching)
+    _bases[key] = basis
+    if len(_bases) > max_bases:
+        _bases.popitem(last=False)
+    return basis
+
+def zernike_opd(coefficients, basis):
+    """OPD map(s) from Zernike coefficients, as one matrix product
+
+    Parameters
+    ----------
+    coefficients : array_like
+        Coefficients in metres RMS, in Noll order from piston; either one
+        set, or an array of shape (nsamples, nterms). May have fewer terms
+        than the basis.
+
+    basis : numpy ndarray
+        Basis stack, from build_basis or zernike_basis
+
+    Returns
+    -------
+    opd : numpy ndarray
+        OPD map(s) in metres over the basis box
+    """
+    coefficients = np.asarray(coefficients, dtype = np.float64)
+    nterms = coefficients.shape[-1]
+    box = basis.shape[1:]
+    flat = basis[:nterms].reshape(nterms, -1)
+    return np.dot(coefficients, flat).reshape(coefficients.shape[:-1] + box)
+
+def zernike_support(wfo, coefficients, radius, use_caching=True):
+    """Zernike OPD as a support, for apply_opd_support
+
+    Parameters
+    ----------
+    wfo : obj
+        WaveFront class object
+
+    coefficients : array_like
+        One set of coefficients, as for zernike_opd
+
+    radius : float
+        Pupil radius in metres
+
+    use_caching : bool
+        As for zernike_basis
+
+    Returns
+    -------
+    support : dict
+        As from pupil_support.grid_support, with outside 0
+    """
+    basis = zernike_basis(wfo, len(coefficients), radius, use_caching)
+    ngrid = proper.prop_get_gridsize(wfo)
+    lo, hi = _box(ngrid, proper.prop_get_sampling(wfo), radius)
+    # Wavefront arrays hold centred pixel c at (c + n//2) % n
+    idx = (np.arange(lo, hi) + ngrid//2) % ngrid
+    return {'rows': idx, 'cols': idx, 'values': zernike_opd(coefficients, basis), 'outside': 0.}
+
+def random_coefficients(nsamples, nterms, rms, first=4, power=0., seed=None):
+    """Random Zernike coefficients for tolerance Monte Carlo
+
+    Parameters
+    ----------
+    nsamples : int
+        Number of coefficient sets
+
+    nterms : int
+        Number of terms in each set
+
+    rms : float
+        Expected total RMS OPD in metres
+
+    first : int
+        First Noll index to perturb; by default piston and tilts are left at
+        zero, as they only shift the image
+
+    power : float
+        Each term's standard deviation falls as (n + 1)**-power with its
+        radial order n; 0 for equal weight on every term
+
+    seed : int
+        Random seed, for reproducible samples
+
+    Returns
+    -------
+    coefficients : numpy ndarray
+        Array of shape (nsamples, nterms) in metres
+    """
+    sigma = np.zeros(nterms, dtype = np.float64)
+    for j in range(first, nterms + 1):
+        sigma[j - 1] = (noll_index(j)[0] + 1.)**-power
+    total = np.sqrt(np.sum(sigma**2))
+    if total > 0:
+        sigma *= rms / total
+    return np.random.RandomState(seed).normal(size=(nsamples, nterms)) * sigma
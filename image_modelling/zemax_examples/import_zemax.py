@@ -1,10 +1,240 @@
-import numpy as np
-import codecs
+"""Convert Zemax text exports (PSF, wavefront map) to numpy binary files
+
+Usage: python import_zemax.py [--force] [--processes N] FILE [FILE ...]
+
+Each FILE.txt is converted to FILE.npy, with the grid size, sampling and
+other header metadata in FILE.json (spacings in metres). Rows are streamed
+from the export straight into a memory-mapped output, so large exports are
+never held in memory, and files are converted in parallel. Files whose
+output is newer than the export are skipped unless --force is given.
+"""
+import argparse
+import io
+import json
 import os
-import sys
+import re
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from numpy.lib.format import open_memmap
+
+# Length units used in Zemax headers, in metres
+UNITS = {'m': 1., 'meters': 1., 'mm': 1e-3, 'millimeters': 1e-3,
+         'µm': 1e-6, 'um': 1e-6, 'microns': 1e-6, 'nm': 1e-9}
+
+_number = r'([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)'
+_grid_size = re.compile(r'^(.*?)\s*grid size\s*:\s*(\d+)\s*by\s*(\d+)', re.IGNORECASE)
+_spacing = re.compile(r'^(\w+) spacing is\s*' + _number + r'\s*(\S+?)\.?$', re.IGNORECASE)
+_width = re.compile(r'^Data area is\s*' + _number + r'\s*(\S+?)\s', re.IGNORECASE)
+_centre = re.compile(r'^Center point is\s*:\s*row\s*(\d+)\s*,\s*column\s*(\d+)', re.IGNORECASE)
+_wavelength = re.compile(r'^' + _number + r'\s*(?:to\s*' + _number + r'\s*)?(\S+)\s+at\s', re.IGNORECASE)
+_value = re.compile(r'^([^:]+?)\s*:\s*' + _number + r'\s*$')
+
+def _metres(value, unit):
+    return float(value) * UNITS[unit.lower()]
+
+def parse_header(lines):
+    """Parse the header of a Zemax text export
+
+    Parameters
+    ----------
+    lines : list of str
+        Header lines, up to (not including) the first row of data
+
+    Returns
+    -------
+    meta : dict
+        Whatever was found of 'title', 'shape' (rows, columns of the data),
+        'spacing' (metres), 'centre' (0-based row, column), 'wavelengths'
+        (metres), and other 'name: number' lines such as 'Strehl ratio'
+    """
+    meta = {}
+    lines = [line.strip() for line in lines]
+    titles = [line for line in lines if line]
+    if titles:
+        meta['title'] = titles[0]
+    for line in lines:
+        m = _grid_size.match(line)
+        if m:
+            name = m.group(1).lower()
+            shape = [int(m.group(2)), int(m.group(3))]
+            meta[name.replace(' ', '_') + '_grid'] = shape
+            # Image grids of PSFs, or the only grid of wavefront maps
+            if name == 'image' or 'shape' not in meta:
+                meta['shape'] = shape
+            continue
+        m = _spacing.match(line)
+        if m and m.group(3).lower() in UNITS:
+            meta['spacing'] = _metres(m.group(2), m.group(3))
+            continue
+        m = _width.match(line)
+        if m and m.group(2).lower() in UNITS:
+            meta['width'] = _metres(m.group(1), m.group(2))
+            continue
+        m = _centre.match(line)
+        if m:
+            meta['centre'] = [int(m.group(1)) - 1, int(m.group(2)) - 1]
+            continue
+        m = _wavelength.match(line)
+        if m and m.group(3).lower() in UNITS:
+            wl = [_metres(m.group(1), m.group(3))]
+            if m.group(2) is not None:
+                wl.append(_metres(m.group(2), m.group(3)))
+            meta['wavelengths'] = wl
+            continue
+        m = _value.match(line)
+        if m:
+            meta[m.group(1).lower().replace(' ', '_')] = float(m.group(2))
+    return meta
+
+def _data_row(line, ncols):
+    # Row of ncols numbers (any number if ncols is None), or None
+    fields = line.split()
+    if len(fields) == 0 or (ncols is not None and len(fields) != ncols):
+        return None
+    try:
+        return np.array(fields, dtype = np.float64)
+    except ValueError:
+        return None
+
+def is_current(filename, output):
+    """True if output exists and is newer than filename"""
+    return os.path.exists(output) and os.path.getmtime(output) >= os.path.getmtime(filename)
+
+def convert(filename, output=None, force=False):
+    """Convert one Zemax text export to a numpy binary file
+
+    Parameters
+    ----------
+    filename : str
+        UTF-16 Zemax text export
+
+    output : str
+        Output .npy filename. Default is filename with extension .npy. The
+        header metadata is written alongside, with extension .json.
+
+    force : bool
+        Convert even if the output is newer than filename
+
+    Returns
+    -------
+    output : str or None
+        Output filename, or None if it was already up to date
+    """
+    base = os.path.splitext(output or filename)[0]
+    output = base + '.npy'
+    meta_file = base + '.json'
+    if not force and is_current(filename, output) and is_current(filename, meta_file):
+        return None
+
+    with io.open(filename, encoding='utf-16') as f:
+        header = []
+        first = None
+        for line in f:
+            first = _data_row(line, None)
+            if first is not None:
+                break
+            header.append(line)
+        if first is None:
+            raise ValueError('No data found in {}'.format(filename))
+        meta = parse_header(header)
+        shape = meta.get('shape')
+        if shape is None or shape[1] != first.size:
+            # Assume a square grid
+            shape = meta['shape'] = [first.size, first.size]
+
+        # Write to a temporary file, so a partial conversion is never used
+        tmp = output + '.{}.tmp'.format(os.getpid())
+        data = open_memmap(tmp, mode='w+', dtype=np.float64, shape=tuple(shape))
+        try:
+            data[0] = first
+            row = 1
+            for line in f:
+                if row == shape[0]:
+                    break
+                values = _data_row(line, shape[1])
+                if values is None:
+                    continue
+                data[row] = values
+                row += 1
+            if row != shape[0]:
+                raise ValueError('{} has {} rows of data, expected {}'.format(filename, row, shape[0]))
+            data.flush()
+            # Release the memory map before the rename
+            data = None
+            os.replace(tmp, output)
+        except BaseException:
+            data = None
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=1)
+    return output
+
+def load_zemax(filename, mmap_mode='r'):
+    """Load a converted Zemax export and its metadata
+
+    Parameters
+    ----------
+    filename : str
+        Converted .npy file (or the original export's name)
+
+    mmap_mode : str
+        As for numpy.load
+
+    Returns
+    -------
+    data : numpy ndarray
+        Converted grid, memory mapped by default
+
+    meta : dict
+        Header metadata, see parse_header
+    """
+    base = os.path.splitext(filename)[0]
+    data = np.load(base + '.npy', mmap_mode=mmap_mode)
+    meta = {}
+    if os.path.exists(base + '.json'):
+        with open(base + '.json') as f:
+            meta = json.load(f)
+    return data, meta
+
+def convert_all(filenames, force=False, processes=None):
+    """Convert Zemax text exports in parallel
+
+    Parameters
+    ----------
+    filenames : list of str
+        UTF-16 Zemax text exports
+
+    force : bool
+        Convert even files whose output is up to date
+
+    processes : int
+        Number of worker processes. Default is the number of CPUs.
+
+    Returns
+    -------
+    outputs : list of str or None
+        Output filename for each file, None where it was up to date
+    """
+    if len(filenames) <= 1 or processes == 1:
+        return [convert(filename, force=force) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(convert, filename, None, force) for filename in filenames]
+        return [future.result() for future in futures]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert Zemax text exports to numpy binary files')
+    parser.add_argument('files', nargs='+', help='Zemax text exports')
+    parser.add_argument('--force', action='store_true', help='convert files that are up to date')
+    parser.add_argument('--processes', type=int, help='worker processes (default: number of CPUs)')
+    args = parser.parse_args(argv)
+    for filename, output in zip(args.files, convert_all(args.files, args.force, args.processes)):
+        if output is None:
+            print('{}: up to date'.format(filename))
+        else:
+            print('{} -> {}'.format(filename, output))
 
-for filename in sys.argv[1:]:
-    with codecs.open(filename, encoding='utf-16') as f:
-        data = np.loadtxt(f, skiprows=21)
-    # Export it as a more convenient (and compact) numpy binary file
-    np.save(os.path.splitext(filename)[0], data)
+if __name__ == '__main__':
+    main()